@@ -0,0 +1,97 @@
+import json
+import logging
+import re
+import subprocess
+import sys
+from pathlib import Path
+
+import click
+
+
+# seconds a fresh interpreter may spend importing each module, numpy and
+# pandas alone take about 0.35 s of it; heavy dependencies (dask,
+# matplotlib, seaborn, plotly, sklearn) are only imported by the
+# functions using them
+IMPORT_BUDGETS = {
+    'src.data.store': 0.6,
+    'src.data.make_dataset': 0.7,
+    'src.features.build_features': 0.7,
+    'src.models.predict_model': 0.8,
+    'src.models.train_model': 0.8,
+    'src.visualization.visualize': 0.8
+}
+
+# modules that should not be loaded by importing the ones above
+HEAVY_MODULES = ['dask', 'matplotlib', 'seaborn', 'plotly', 'sklearn']
+
+
+def measure_import(module, repeat=5):
+    '''
+    module: module to import in a fresh interpreter
+    repeat: interpreters started, the fastest import is reported
+
+    returns the import time in seconds and the heavy modules it loaded
+    '''
+    code = (f"import json, sys, {module}; "
+            f"print(json.dumps([m for m in {HEAVY_MODULES} "
+            f"if m in sys.modules]))")
+    seconds = []
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            capture_output=True, text=True, check=True)
+        # 'import time: self [us] | cumulative | imported package', the
+        # cumulative time of the module line covers its dependencies
+        pattern = rf"\|\s*(\d+)\s*\|\s*{re.escape(module)}$"
+        cumulative = re.search(pattern, process.stderr, re.MULTILINE)
+        seconds.append(int(cumulative.group(1)) / 1e6)
+    return min(seconds), json.loads(process.stdout)
+
+
+def check_import_budgets(budgets=IMPORT_BUDGETS, repeat=5):
+    '''
+    budgets: module -> seconds
+    repeat: interpreters started per module
+
+    returns module -> seconds, budget and heavy modules loaded
+    '''
+    logger = logging.getLogger(__name__)
+    results = {}
+    for module, budget in budgets.items():
+        seconds, heavy = measure_import(module, repeat=repeat)
+        results[module] = {'seconds': seconds, 'budget': budget,
+                           'heavy_modules': heavy}
+        logger.info(f"{module}: {seconds:.3f} s (budget {budget} s)"
+                    + (f", loads {', '.join(heavy)}" if heavy else ''))
+    return results
+
+
+@click.command()
+@click.argument('output_filepath', type=click.Path(),
+                default='reports/benchmarks/import-time.json')
+@click.option('--repeat', type=int, default=5, show_default=True)
+def main(output_filepath, repeat):
+    """ Measures the import time of the package modules and fails if one
+        is over its budget (saved in ../reports/benchmarks).
+    """
+    logger = logging.getLogger(__name__)
+    results = check_import_budgets(repeat=repeat)
+
+    output_filepath = Path(output_filepath)
+    output_filepath.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_filepath, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    over = [module for module, result in results.items()
+            if result['seconds'] > result['budget']
+            or result['heavy_modules']]
+    for module in over:
+        logger.warning(f"{module} is over its import budget")
+    if over:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
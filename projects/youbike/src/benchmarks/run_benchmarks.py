@@ -0,0 +1,187 @@
+import json
+import logging
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.benchmarks.synthetic import SCALES, make_raw_data
+from src.data.make_dataset import (
+    _join_weather_air, get_air_history_data, get_weather_history_data,
+    get_youbike_history_data, get_youbike_integration_df
+)
+from src.visualization.visualize import get_weekday_profiles
+
+
+BENCHMARK_DIR = 'reports/benchmarks'
+
+
+def measure(func, *args, repeat=3, **kwargs):
+    '''
+    func: stage to run
+    repeat: timed runs, the fastest one is reported
+
+    returns the result of func and its best wall time in seconds and
+    peak traced memory in MB, memory is traced in one extra run so it
+    does not slow the timed ones down
+    '''
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, {'seconds': min(seconds),
+                    'peak_memory_mb': peak / 2 ** 20}
+
+
+def _rows(result):
+    return int(sum(len(df) for df in result)) if isinstance(
+        result, list) else int(len(result))
+
+
+def run_benchmarks(data_dir, years, repeat=3):
+    '''
+    data_dir: raw data directory, see synthetic.make_raw_data
+    years: weather and air years in data_dir
+    repeat: timed runs per stage
+
+    returns stage name -> seconds, peak_memory_mb and rows
+    '''
+    logger = logging.getLogger(__name__)
+    stages = {}
+
+    def run(name, func, *args, **kwargs):
+        result, stats = measure(func, *args, repeat=repeat, **kwargs)
+        stages[name] = dict(stats, rows=_rows(result))
+        logger.info(f"{name}: {stats['seconds']:.3f} s, "
+                    f"{stats['peak_memory_mb']:.1f} MB")
+        return result
+
+    weather_dfs = run('get_weather_history_data', lambda: [
+        get_weather_history_data(year, data_dir) for year in years])
+    air_dfs = run('get_air_history_data', lambda: [
+        get_air_history_data(year, data_dir) for year in years])
+    youbike_df = run('get_youbike_history_data', get_youbike_history_data,
+                     data_dir=data_dir)
+
+    weather_air_df = pd.concat([
+        _join_weather_air(weather_df, air_df)
+        for weather_df, air_df in zip(weather_dfs, air_dfs)])
+    integration_df = run('get_youbike_integration_df',
+                         get_youbike_integration_df,
+                         youbike_df, weather_air_df)
+    run('get_weekday_profiles', get_weekday_profiles, integration_df)
+    return stages
+
+
+def _git_version():
+    try:
+        return subprocess.run(
+            ['git', 'describe', '--always', '--dirty'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    '''
+    results: benchmark results, see main
+    baseline: earlier benchmark results of the same scale
+    tolerance: allowed relative slowdown or memory growth
+
+    returns a message per stage metric that regressed
+    '''
+    if results['scale'] != baseline['scale']:
+        raise ValueError(f"Baseline scale {baseline['scale']} differs from "
+                         f"{results['scale']}")
+    regressions = []
+    for name, stats in results['stages'].items():
+        before = baseline['stages'].get(name)
+        if before is None:
+            continue
+        for metric in ['seconds', 'peak_memory_mb']:
+            if stats[metric] > before[metric] * (1 + tolerance):
+                regressions.append(
+                    f"{name} {metric}: {before[metric]:.3f} -> "
+                    f"{stats[metric]:.3f}")
+    return regressions
+
+
+@click.command()
+@click.argument('output_dir', type=click.Path(), default=BENCHMARK_DIR)
+@click.option('--scale', type=click.Choice(list(SCALES)),
+              default='station-month', show_default=True)
+@click.option('--stations', type=int, help='Overrides the scale.')
+@click.option('--months', type=int, help='Overrides the scale.')
+@click.option('--data-dir', type=click.Path(),
+              help='Keeps the synthetic raw data here instead of a '
+                   'temporary directory, existing data is reused.')
+@click.option('--repeat', type=int, default=3, show_default=True)
+@click.option('--baseline', type=click.Path(exists=True),
+              help='Earlier results to check for regressions.')
+@click.option('--tolerance', type=float, default=0.2, show_default=True)
+def main(output_dir, scale, stations, months, data_dir, repeat, baseline,
+         tolerance):
+    """ Times and memory-profiles the data stages on synthetic raw data
+        and saves the results as json (saved in ../reports/benchmarks).
+    """
+    logger = logging.getLogger(__name__)
+    stations = stations or SCALES[scale][0]
+    months = months or SCALES[scale][1]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_dir = Path(data_dir or tmp_dir)
+        years = sorted(int(path.name.split('-')[-1]) for path in
+                       raw_dir.glob('taipei-weather-*'))
+        if not years:
+            logger.info(f"generating {stations} stations x {months} "
+                        f"months of raw data")
+            years, _ = make_raw_data(raw_dir, stations=stations,
+                                     months=months)
+        stages = run_benchmarks(str(raw_dir), years, repeat=repeat)
+
+    results = {
+        'version': _git_version(),
+        'created': pd.Timestamp.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'scale': {'stations': stations, 'months': months},
+        'stages': stages
+    }
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir / (
+        f"{stations}-stations-{months}-months-"
+        f"{pd.Timestamp.now():%Y%m%d-%H%M%S}.json")
+    with open(output_path, 'w') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    logger.info(f"saved results to {output_path}")
+
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare_results(results, json.load(f), tolerance)
+        for regression in regressions:
+            logger.warning(f"regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
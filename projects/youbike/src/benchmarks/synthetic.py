@@ -0,0 +1,214 @@
+import zipfile
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data.make_dataset import YOUBIKE_FIELDS_LIST
+
+
+# stations, months
+SCALES = {
+    'station-month': (1, 1),
+    'district-quarter': (30, 3),
+    'city-year': (400, 12),
+    'city-5-years': (400, 60)
+}
+
+AREAS = [
+    '中正區', '大同區', '中山區', '松山區', '大安區', '萬華區',
+    '信義區', '士林區', '北投區', '內湖區', '南港區', '文山區'
+]
+
+AIR_ITEMS = [
+    '小時風向值  ()',
+    '細懸浮微粒 PM 2.5  (μg/m 3 )',
+    '總碳氫化合物 THC (ppm)',
+    '小時風速值 WS_HR (m/sec)',
+    '小時風向值 WD_HR (degrees)',
+    '風向 WIND_DIREC (degrees)',
+    '相對濕度 RH (percent)',
+    '懸浮微粒 PM 10  (μg/m 3 )',
+    '甲烷 CH4 (ppm)',
+    '風速 WIND_SPEED (m/sec)',
+    '非甲烷碳氫化合物 NMHC (ppm)',
+    '一氧化碳 CO (ppm)',
+    '二氧化氮 NO2 (ppb)',
+    '氮氧化物 NOx (ppb)',
+    '二氧化硫 SO2 (ppb)',
+    '臭氧 O3 (ppb)',
+    '溫度 AMB_TEMP (℃)'
+]
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def _days(start, months):
+    start = pd.Timestamp(start).normalize()
+    return pd.date_range(start, start + pd.DateOffset(months=months),
+                         freq='D', inclusive='left')
+
+
+def _youbike_week(rng, stations, times):
+    # one row per (time, station), stations laid out as in the raw dumps
+    n_stations, n_times = len(stations), len(times)
+    minutes = (times.hour * 60 + times.minute).values
+    daily = np.sin(2 * np.pi * minutes / 1440)
+    total = stations['total_number'].values
+    current = (total[None, :] / 2
+               * (1 + daily[:, None] * stations['phase'].values[None, :])
+               + rng.normal(0, 2, (n_times, n_stations)))
+    current = current.clip(0, total[None, :]).round().astype(int)
+
+    def repeat(column):
+        return np.tile(stations[column].values, n_times)
+
+    stamps = np.repeat(times.strftime(TIME_FORMAT).values, n_stations)
+    df = pd.DataFrame({
+        'stop_no': repeat('stop_no'),
+        'stop_name': repeat('stop_name'),
+        'total_number': repeat('total_number'),
+        'current_number': current.ravel(),
+        'stop_area': repeat('stop_area'),
+        'update_time': stamps,
+        'lat': repeat('lat'),
+        'lng': repeat('lng'),
+        'address': repeat('address'),
+        'stop_area_en': repeat('stop_area'),
+        'stop_name_en': repeat('stop_name'),
+        'address_en': repeat('address'),
+        'vacancy_number': repeat('total_number') - current.ravel(),
+        # about one row in a hundred comes from a disabled station
+        'status': (rng.random(n_times * n_stations) > 0.01).astype(int),
+        'batch_update_time': stamps,
+        'db_update_time': stamps,
+        'update_info_time': stamps,
+        'update_info_date': stamps
+    })
+    return df[YOUBIKE_FIELDS_LIST]
+
+
+def make_youbike_zips(data_dir, stations=1, start='2018-01-01', months=1,
+                      freq='5min', files=2, seed=0):
+    '''
+    data_dir: directory the youbike-history-data-*.csv.zip files go to
+    stations: number of stations
+    start: first day
+    months: months of history
+    freq: time between two snapshots
+    files: number of zips the history is split into, by time
+    seed: random seed
+
+    Writes the 18 header-less fields of the raw dumps a week at a time,
+    so any scale fits in memory. Returns the number of rows.
+    '''
+    rng = np.random.default_rng(seed)
+    stations = pd.DataFrame({
+        'stop_no': np.arange(1, stations + 1),
+        'stop_name': [f"站{i}" for i in range(1, stations + 1)],
+        'stop_area': rng.choice(AREAS, stations),
+        'total_number': rng.integers(20, 80, stations),
+        'lat': rng.uniform(24.96, 25.21, stations).round(6),
+        'lng': rng.uniform(121.45, 121.67, stations).round(6),
+        'address': [f"路{i}號" for i in range(1, stations + 1)],
+        'phase': rng.uniform(-0.8, 0.8, stations)
+    })
+
+    days = _days(start, months)
+    rows = 0
+    for i, file_days in enumerate(np.array_split(days, files)):
+        path = Path(data_dir) / f"youbike-history-data-{i + 1}.csv.zip"
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf, \
+                zf.open(path.name[:-len('.zip')], 'w') as f:
+            for week in np.array_split(file_days,
+                                       max(len(file_days) // 7, 1)):
+                if not len(week):
+                    continue
+                times = pd.date_range(week[0], week[-1] + pd.Timedelta('1D'),
+                                      freq=freq, inclusive='left')
+                df = _youbike_week(rng, stations, times)
+                f.write(df.to_csv(header=False, index=False).encode())
+                rows += len(df)
+    return rows
+
+
+def make_weather_csvs(data_dir, start='2018-01-01', months=1, seed=0):
+    '''
+    data_dir: directory the taipei-weather-<year> directories go to
+    start: first day
+    months: months of history
+    seed: random seed
+
+    Writes one csv of 24 hourly rows per day, with the markers of
+    missing values the loader handles.
+    '''
+    rng = np.random.default_rng(seed)
+    for day in _days(start, months):
+        hours = np.arange(24)
+        values = rng.normal(0, 1, (24, 12)).round(1)
+        values[:, 3] = (22 + 6 * np.sin(2 * np.pi * (hours - 9) / 24)
+                        + rng.normal(0, 1, 24)).round(1)
+        values[:, 5] = rng.uniform(55, 98, 24).round()
+        values[:, 6] = rng.gamma(2, 1.2, 24).round(1)
+        values[:, 7] = rng.uniform(0, 360, 24).round()
+        values[:, 10] = np.where(rng.random(24) < 0.85, 0,
+                                 rng.gamma(1, 3, 24)).round(1)
+        df = pd.DataFrame(values, columns=[f"c{i}" for i in range(12)])
+        df = df.astype(object)
+        for column in [3, 5, 6, 7, 10]:
+            df.iloc[rng.random(24) < 0.02, column] = rng.choice(
+                ['/', 'X', 'T', 'V', '...'])
+
+        directory = Path(data_dir) / f"taipei-weather-{day.year}"
+        directory.mkdir(parents=True, exist_ok=True)
+        df.to_csv(directory / f"{day:%Y-%m-%d}.csv", index=False)
+
+
+def make_air_csvs(data_dir, start='2018-01-01', months=1, seed=0):
+    '''
+    data_dir: directory the taipei-air-<year>.csv files go to
+    start: first day
+    months: months of history
+    seed: random seed
+
+    Writes the wide layout of the raw file, one row per (date, item)
+    with 24 hour columns, a unit row below the header and 'x' for
+    invalid readings.
+    '''
+    rng = np.random.default_rng(seed)
+    hour_columns = [f"{hour:02d}" for hour in range(24)]
+    days = _days(start, months)
+    for year in days.year.unique():
+        year_days = days[days.year == year]
+        n = len(year_days) * len(AIR_ITEMS)
+        values = rng.gamma(2, 10, (n, 24)).round(2).astype(object)
+        values[rng.random((n, 24)) < 0.01] = 'x'
+        df = pd.DataFrame(values, columns=hour_columns)
+        df.insert(0, '測項', np.tile(AIR_ITEMS, len(year_days)))
+        df.insert(0, '監測日期', np.repeat(
+            year_days.strftime('%Y/%m/%d'), len(AIR_ITEMS)))
+        for column in ['測站', '鄉鎮', '空品區', '縣市'][::-1]:
+            df.insert(0, column, '中山')
+        unit = pd.DataFrame([['----'] * df.shape[1]], columns=df.columns)
+        pd.concat([unit, df]).to_csv(
+            Path(data_dir) / f"taipei-air-{year}.csv", index=False)
+
+
+def make_raw_data(data_dir, stations=1, start='2018-01-01', months=1,
+                  seed=0):
+    '''
+    data_dir: directory the raw files go to, laid out like the
+              RAW_DATA_DIR of make_dataset
+    stations: number of stations
+    start: first day
+    months: months of history
+    seed: random seed
+
+    returns the years covered and the number of youbike rows
+    '''
+    Path(data_dir).mkdir(parents=True, exist_ok=True)
+    make_weather_csvs(data_dir, start=start, months=months, seed=seed)
+    make_air_csvs(data_dir, start=start, months=months, seed=seed)
+    rows = make_youbike_zips(data_dir, stations=stations, start=start,
+                             months=months, seed=seed)
+    return sorted(_days(start, months).year.unique()), rows
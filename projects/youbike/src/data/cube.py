@@ -0,0 +1,170 @@
+from pathlib import Path
+
+import pandas as pd
+
+from src.data.store import (
+    CUBE_STORE_PATH, compact_parquet_store, read_youbike_store,
+    write_parquet_store
+)
+
+
+# level name -> bucket width, finest first
+CUBE_LEVELS = {
+    '5min': '5min',
+    '1h': '1h',
+    '1d': '1D',
+    '1w': '7D'
+}
+
+CUBE_COLUMNS = ['current_number', 'vacancy_number']
+
+# how the stats of one bucket are combined, they are all mergeable so
+# rows appended by later updates are simply merged when read
+_MERGE = {
+    'sum': 'sum',
+    'count': 'sum',
+    'min': 'min',
+    'max': 'max'
+}
+
+# buckets are aligned to a monday so that weeks start on mondays
+_ANCHOR = pd.Timestamp('1970-01-05')
+
+
+def _bucket_starts(times, width):
+    ns = pd.DatetimeIndex(times).asi8 - _ANCHOR.value
+    step = pd.Timedelta(width).value
+    return pd.DatetimeIndex(ns // step * step + _ANCHOR.value,
+                            name='db_update_time')
+
+
+def _merge(stats, width=None):
+    # combine the stats of the same station and bucket, coarsened to
+    # width first if given
+    keys = [stats.index.get_level_values(i)
+            for i in range(stats.index.nlevels)]
+    if width is not None:
+        keys[-1] = _bucket_starts(keys[-1], width)
+    how = {column: _MERGE[column.rsplit('_', 1)[1]]
+           for column in stats.columns}
+    return stats.groupby(keys).agg(how)
+
+
+def build_cube(df, columns=CUBE_COLUMNS, levels=CUBE_LEVELS):
+    '''
+    df: youbike dataframe indexed by (stop_no, time), or with stop_no and
+        db_update_time columns
+    columns: columns to roll up
+    levels: level name -> bucket width, finest first
+
+    returns level name -> sum, count, min and max of every column per
+    (stop_no, bucket start)
+    '''
+    if 'db_update_time' in df.columns:
+        df = df.set_index(['stop_no', 'db_update_time'])
+    df = df[columns]
+
+    widths = list(levels.values())
+    stats = df.groupby([df.index.get_level_values(0),
+                        _bucket_starts(df.index.get_level_values(-1),
+                                       widths[0])]).agg(list(_MERGE))
+    stats.columns = [f"{column}_{stat}" for column, stat in stats.columns]
+    # sums of int16 readings overflow int16 within a day of a station
+    stats = stats.astype({column: 'int64' for column in stats.columns
+                          if column.endswith(('_sum', '_count'))})
+
+    # every coarser level is rolled up from the previous one
+    cube = {}
+    for name, width in levels.items():
+        stats = _merge(stats, width) if cube else stats
+        cube[name] = stats
+    return cube
+
+
+def update_cube(df, path=CUBE_STORE_PATH, columns=CUBE_COLUMNS):
+    '''
+    df: new youbike rows, see build_cube
+    path: cube root directory, one store per level is kept in it
+
+    Buckets that were only partially covered by earlier updates get one
+    more row, they are merged when read.
+    '''
+    for name, stats in build_cube(df, columns=columns).items():
+        write_parquet_store(stats, Path(path) / name, 'db_update_time',
+                            partition_cols=['stop_no'])
+
+
+def _merge_partition(df):
+    # rows of one station partition, the buckets written by different
+    # updates are merged into one row
+    how = {column: _MERGE[column.rsplit('_', 1)[1]]
+           for column in df.columns if column != 'db_update_time'}
+    return df.groupby('db_update_time', as_index=False).agg(how)
+
+
+def compact_cube(path=CUBE_STORE_PATH, months=None, min_files=2,
+                 executor=None):
+    '''
+    path: cube root directory
+    months: only compact the partitions of these 'YYYY-MM' months
+    min_files: partitions with fewer files are left as they are
+    executor: executor the partitions are compacted in
+
+    Rewrites the files of every partition of every level as one, with
+    one row per bucket. Returns the files replaced.
+    '''
+    return sum(compact_parquet_store(Path(path) / name, 'db_update_time',
+                                     combine=_merge_partition, months=months,
+                                     min_files=min_files, executor=executor)
+               for name in CUBE_LEVELS if (Path(path) / name).exists())
+
+
+def select_level(start, end, max_points, levels=CUBE_LEVELS):
+    '''
+    start: start datetime
+    end: end datetime
+    max_points: buckets a station may return
+    levels: level name -> bucket width, finest first
+
+    returns the finest level with at most max_points buckets between
+    start and end, or the coarsest one
+    '''
+    span = pd.Timestamp(end) - pd.Timestamp(start)
+    for name, width in levels.items():
+        if span // pd.Timedelta(width) + 1 <= max_points:
+            return name
+    return name
+
+
+def query_cube(start, end, stop_no=None, max_points=1000, level=None,
+               path=CUBE_STORE_PATH):
+    '''
+    start: start datetime included
+    end: end datetime included
+    stop_no: a station or a list of stations, None reads all of them
+    max_points: buckets per station, picks the level if level is None
+    level: level name, see CUBE_LEVELS
+    path: cube root directory
+
+    returns the mean, min, max and count of every column per bucket,
+    indexed by time for one station and by (stop_no, time) otherwise
+    '''
+    if level is None:
+        level = select_level(start, end, max_points)
+    start = _bucket_starts([start], CUBE_LEVELS[level])[0]
+    stats = read_youbike_store(Path(path) / level, stop_no=stop_no,
+                               start=start, end=end)
+    # one station comes back indexed by time with a stop_no column
+    stats = _merge(stats.drop(columns='stop_no', errors='ignore'))
+    stats.index.names = (['stop_no'] * (stats.index.nlevels - 1)
+                         + ['db_update_time'])
+
+    df = pd.DataFrame(index=stats.index)
+    for column in [c[:-len('_sum')] for c in stats.columns
+                   if c.endswith('_sum')]:
+        count = stats[f"{column}_count"]
+        df[f"{column}_mean"] = stats[f"{column}_sum"] / count.where(count > 0)
+        df[f"{column}_min"] = stats[f"{column}_min"]
+        df[f"{column}_max"] = stats[f"{column}_max"]
+        df[f"{column}_count"] = count
+    return df
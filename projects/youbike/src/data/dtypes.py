@@ -0,0 +1,87 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+
+YOUBIKE_DTYPES = {
+    'stop_no': 'int32',
+    'stop_name': 'category',
+    'stop_area': 'category',
+    'lat': 'float32',
+    'lng': 'float32',
+    'total_number': 'int16',
+    'current_number': 'int16',
+    'vacancy_number': 'int16',
+    'status': 'int8'
+}
+
+# dtypes of the columns of every loaded frame, numeric columns that are
+# not listed are downcast to float32 or the smallest int that fits
+SCHEMA = dict(
+    YOUBIKE_DTYPES,
+    weekday='int8',
+    is_weekend='bool',
+    可借車數='int16',
+    是否為週末='bool',
+    星期幾=pd.CategoricalDtype(WEEKDAYS)
+)
+
+# object columns with at most this share of distinct values become
+# categoricals
+CATEGORY_RATIO = 0.5
+
+
+def memory_usage(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+def weekday_categorical(weekdays):
+    '''
+    weekdays: weekday numbers, monday is 0
+    '''
+    return pd.Categorical.from_codes(np.asarray(weekdays, dtype='int8'),
+                                     dtype=SCHEMA['星期幾'])
+
+
+def _compact_dtype(series):
+    if pd.api.types.is_bool_dtype(series):
+        return None
+    if pd.api.types.is_float_dtype(series):
+        return 'float32'
+    if pd.api.types.is_integer_dtype(series):
+        return pd.to_numeric(series, downcast='integer').dtype
+    if (pd.api.types.is_object_dtype(series) and len(series)
+            and series.nunique() <= CATEGORY_RATIO * len(series)):
+        return 'category'
+    return None
+
+
+def optimize_dtypes(df, schema=SCHEMA, name='frame'):
+    '''
+    df: dataframe
+    schema: column -> dtype, see SCHEMA
+    name: frame name used in the memory report
+
+    returns df with compact dtypes and logs its memory before and after
+    '''
+    before = memory_usage(df)
+    dtypes = {}
+    for column in df.columns:
+        dtype = schema.get(column) or _compact_dtype(df[column])
+        # missing values only fit a float
+        if (dtype is not None and pd.api.types.is_integer_dtype(dtype)
+                and df[column].isna().any()):
+            dtype = 'float32'
+        if dtype is not None and df[column].dtype != dtype:
+            dtypes[column] = dtype
+    if dtypes:
+        df = df.astype(dtypes)
+
+    after = memory_usage(df)
+    logging.getLogger(__name__).info(
+        f"{name}: {before / 2 ** 20:.1f} MB -> {after / 2 ** 20:.1f} MB "
+        f"({before / max(after, 1):.1f}x)")
+    return df
@@ -0,0 +1,294 @@
+import asyncio
+import io
+import logging
+import time
+import urllib.request
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.data.cube import compact_cube, update_cube
+from src.data.make_dataset import (
+    _make_youbike_df, _read_state, _update_mark, _write_state,
+    read_youbike_history_chunks
+)
+from src.data.store import (
+    CUBE_STORE_PATH, YOUBIKE_STORE_PATH, _month_strings,
+    compact_parquet_store, write_youbike_store
+)
+
+
+RING_COLUMNS = ['current_number', 'vacancy_number']
+
+
+class FileTransport:
+    '''
+    Reads snapshots from a local file that is replaced by another
+    process, a stand-in for the live feed.
+    '''
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    async def fetch(self):
+        return await asyncio.to_thread(self.path.read_bytes)
+
+
+class HTTPTransport:
+    '''
+    Downloads snapshots from an url.
+    '''
+
+    def __init__(self, url, timeout=10):
+        self.url = url
+        self.timeout = timeout
+
+    def _get(self):
+        with urllib.request.urlopen(self.url, timeout=self.timeout) as r:
+            return r.read()
+
+    async def fetch(self):
+        return await asyncio.to_thread(self._get)
+
+
+def parse_snapshot(data):
+    '''
+    data: bytes of a city-wide snapshot, header-less csv rows with the 18
+          fields of the youbike history zips
+
+    returns the enabled stations, see _make_youbike_df
+    '''
+    chunks = list(read_youbike_history_chunks([io.BytesIO(data)]))
+    return _make_youbike_df(chunks)
+
+
+class StationRingBuffer:
+    '''
+    The last capacity readings of every station in preallocated arrays.
+
+    Every reading is written twice, at its slot and capacity slots
+    later, so the readings of a station in time order are always one
+    contiguous slice and window() returns views instead of copies.
+    '''
+
+    def __init__(self, capacity, columns=RING_COLUMNS, max_stations=512):
+        '''
+        capacity: readings kept per station
+        columns: columns of the snapshots kept
+        max_stations: stations preallocated, grown when exceeded
+        '''
+        self.capacity = capacity
+        self.columns = list(columns)
+        self.stations = pd.Index([], dtype='int64')
+        self.counts = np.zeros(max_stations, dtype='int64')
+        self.times = np.zeros((max_stations, 2 * capacity),
+                              dtype='datetime64[ns]')
+        self.values = np.zeros((len(self.columns), max_stations,
+                                2 * capacity), dtype='float32')
+
+    def _grow(self, n_stations):
+        size = max(n_stations, 2 * len(self.counts))
+        counts = np.zeros(size, self.counts.dtype)
+        counts[:len(self.counts)] = self.counts
+        times = np.zeros((size, 2 * self.capacity), self.times.dtype)
+        times[:len(self.times)] = self.times
+        values = np.zeros((len(self.columns), size, 2 * self.capacity),
+                          self.values.dtype)
+        values[:, :self.values.shape[1]] = self.values
+        self.counts, self.times, self.values = counts, times, values
+
+    def _rows(self, stops):
+        rows = self.stations.get_indexer(stops)
+        new = rows < 0
+        if new.any():
+            self.stations = self.stations.append(
+                pd.Index(np.unique(stops[new]), dtype='int64'))
+            if len(self.stations) > len(self.counts):
+                self._grow(len(self.stations))
+            rows = self.stations.get_indexer(stops)
+        return rows
+
+    def push(self, df):
+        '''
+        df: snapshot rows with stop_no, db_update_time and the columns
+
+        returns the rows added, readings not newer than the last one of
+        their station are skipped
+        '''
+        df = df.drop_duplicates('stop_no', keep='last')
+        stops = df['stop_no'].values.astype('int64')
+        times = df['db_update_time'].values.astype('datetime64[ns]')
+        rows = self._rows(stops)
+
+        last = self.times[rows, (self.counts[rows] - 1) % self.capacity]
+        fresh = (self.counts[rows] == 0) | (times > last)
+        rows, times = rows[fresh], times[fresh]
+        slots = self.counts[rows] % self.capacity
+
+        for upper in [0, self.capacity]:
+            self.times[rows, slots + upper] = times
+            for i, column in enumerate(self.columns):
+                self.values[i, rows, slots + upper] = df[column].values[fresh]
+        self.counts[rows] += 1
+        return df[fresh]
+
+    def window(self, stop_no, column=RING_COLUMNS[0]):
+        '''
+        stop_no: station
+        column: one of the columns
+
+        returns views of the times and values of the station, oldest first
+        '''
+        row = self.stations.get_loc(stop_no)
+        count = self.counts[row]
+        n = min(count, self.capacity)
+        end = (count - 1) % self.capacity + 1 + self.capacity if n else 0
+        values = self.values[self.columns.index(column), row]
+        return self.times[row, end - n:end], values[end - n:end]
+
+    def to_frame(self, stop_no=None):
+        '''
+        stop_no: a station or a list of stations, None returns all of them
+
+        returns a frame indexed by (stop_no, db_update_time), a copy
+        '''
+        stops = self.stations if stop_no is None else np.atleast_1d(stop_no)
+        frames = []
+        for stop in stops:
+            times, _ = self.window(stop)
+            frames.append(pd.DataFrame(
+                {column: self.window(stop, column)[1]
+                 for column in self.columns},
+                index=pd.MultiIndex.from_arrays(
+                    [np.full(len(times), stop), times],
+                    names=['stop_no', 'db_update_time'])))
+        if not frames:
+            return pd.DataFrame(columns=self.columns)
+        return pd.concat(frames)
+
+
+class SnapshotIngester:
+    '''
+    Polls a transport for snapshots, keeps recent readings in a
+    StationRingBuffer and periodically appends the new rows to the stores.
+    '''
+
+    def __init__(self, transport, window='7D', freq='5min',
+                 poll_interval=60, flush_interval=3600,
+                 store_path=YOUBIKE_STORE_PATH, cube_path=CUBE_STORE_PATH,
+                 state_dir=None, compact_files=8):
+        '''
+        transport: object with an async fetch() returning snapshot bytes
+        window: history kept in memory per station
+        freq: time between two readings of a station
+        poll_interval: seconds between two polls
+        flush_interval: seconds between two appends to the stores
+        store_path: youbike store the rows are appended to
+        cube_path: cube the rows are rolled up into, None skips it
+        state_dir: directory of the high-water-marks.json of make_dataset,
+                   defaults to the parent of store_path; its youbike mark
+                   is advanced on flush so --incremental builds do not
+                   append the flushed rows again
+        compact_files: every flush adds a file to each partition it
+                       writes, a partition is compacted into one file
+                       once it holds this many
+        '''
+        self.transport = transport
+        self.buffer = StationRingBuffer(
+            int(pd.Timedelta(window) / pd.Timedelta(freq)))
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.store_path = store_path
+        self.cube_path = cube_path
+        self.state_dir = Path(state_dir or Path(store_path).parent)
+        self.compact_files = compact_files
+        self.pending = []
+
+    async def poll(self):
+        # stations update at different times, freshness is checked per
+        # station by the buffer and only the rows it took are stored
+        df = self.buffer.push(parse_snapshot(await self.transport.fetch()))
+        if len(df):
+            self.pending.append(df)
+        return len(df)
+
+    def flush(self):
+        if not self.pending:
+            return 0
+        df = _make_youbike_df(self.pending)
+        self.pending = []
+        write_youbike_store(df, self.store_path)
+        if self.cube_path is not None:
+            update_cube(df, self.cube_path)
+
+        # only the months just written can have new files
+        months = np.unique(_month_strings(df['db_update_time']))
+        compact_parquet_store(self.store_path, 'db_update_time',
+                              months=months, min_files=self.compact_files)
+        if self.cube_path is not None:
+            compact_cube(self.cube_path, months=months,
+                         min_files=self.compact_files)
+
+        state = _read_state(self.state_dir)
+        _update_mark(state, 'youbike', df['db_update_time'].max())
+        _write_state(self.state_dir, state)
+        return len(df)
+
+    async def run(self, polls=None):
+        '''
+        polls: number of polls before returning, None polls forever
+        '''
+        logger = logging.getLogger(__name__)
+        flushed = time.monotonic()
+        n = 0
+        try:
+            while polls is None or n < polls:
+                n += 1
+                try:
+                    rows = await self.poll()
+                    logger.info(f"ingested {rows} readings")
+                except Exception as e:
+                    logger.warning(f"poll failed: {e}")
+                if time.monotonic() - flushed >= self.flush_interval:
+                    rows = await asyncio.to_thread(self.flush)
+                    logger.info(f"flushed {rows} rows")
+                    flushed = time.monotonic()
+                if polls is None or n < polls:
+                    await asyncio.sleep(self.poll_interval)
+        finally:
+            await asyncio.to_thread(self.flush)
+
+
+@click.command()
+@click.argument('source')
+@click.argument('output_filepath', type=click.Path(),
+                default=YOUBIKE_STORE_PATH)
+@click.option('--poll-interval', type=float, default=60, show_default=True)
+@click.option('--flush-interval', type=float, default=3600,
+              show_default=True)
+@click.option('--window', default='7D', show_default=True,
+              help='History kept in memory per station.')
+@click.option('--compact-files', type=int, default=8, show_default=True,
+              help='Files a partition may hold before it is compacted.')
+def main(source, output_filepath, poll_interval, flush_interval, window,
+         compact_files):
+    """ Polls live snapshots from SOURCE, an url or a file, and appends
+        them to the youbike store (../processed).
+    """
+    transport = (HTTPTransport(source)
+                 if source.startswith(('http://', 'https://'))
+                 else FileTransport(source))
+    ingester = SnapshotIngester(
+        transport, window=window, poll_interval=poll_interval,
+        flush_interval=flush_interval, store_path=output_filepath,
+        cube_path=Path(output_filepath).parent / Path(CUBE_STORE_PATH).name,
+        compact_files=compact_files)
+    asyncio.run(ingester.run())
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -1,26 +1,115 @@
+import io
+import json
+import logging
+import os
+import shutil
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+
+import click
+import numpy as np
 import pandas as pd
-import dask.dataframe as dd
+from pandas.api.types import union_categoricals
+
+from src.data.cube import compact_cube, update_cube
+from src.data.dtypes import (
+    YOUBIKE_DTYPES, optimize_dtypes, weekday_categorical
+)
+from src.data.matrix import update_matrix, write_matrix
+from src.data.profiling import collect, instrument, run_stage, submit
+from src.data.rollup import rollup
+from src.data.store import (
+    YOUBIKE_STORE_PATH, WEATHER_AIR_STORE_PATH,
+    INTEGRATION_STORE_PATH, CUBE_STORE_PATH, MATRIX_STORE_PATH,
+    compact_parquet_store, list_stations, read_time_bounds,
+    read_youbike_store, read_weather_air_store, write_youbike_store,
+    write_weather_air_store, write_integration_store
+)
+
+
+RAW_DATA_DIR = 'drive/My Drive'
+YOUBIKE_FILE_PATTERN = 'youbike-history-data-*.csv.zip'
+# uncompressed csv bytes parsed per task, about 300k rows
+YOUBIKE_BLOCK_SIZE = 64 * 2 ** 20
+STATE_FILE_NAME = 'high-water-marks.json'
+AIR_DATE_FORMAT = '%Y/%m/%d'
+# stations integrated per task, bounds the youbike rows held at a time
+INTEGRATION_BATCH_SIZE = 64
+
+
+def resample_df(df, freq=None, how='mean', cache=None, version=None):
+    '''
+    df: dataframe indexed by time, or by (stop_no, time)
+    freq: resample frequency, ex: H, D, M, None returns df as it is
+    how: mean, min, max or count of the numeric and bool columns
+    cache: RollupCache the rollups are kept in, ex: ROLLUP_CACHE, None
+           skips caching
+    version: token of the data for the cache, defaults to a hash of df
+    '''
+    if not freq:
+        return df
+    # uncached, only the statistic asked for is computed
+    rolled = (rollup(df, freq, stats=[how]) if cache is None
+              else cache.get(df, freq, version=version))
+    return rolled.xs(how, axis=1, level=1)
 
 
-def resample_df(df, freq=None):
-    return df.resample(freq).mean() if freq else df
+def _hourly_timestamps(index, date_str):
+    # one hour per row label, plus one extra day after every label
+    # that closes a 24-hour block (label + 1 divisible by 24)
+    labels = np.asarray(index, dtype='int64')
+    day_closed = ((labels + 1) % 24 == 0).astype('int64')
+    days = np.cumsum(day_closed) - day_closed
+    offsets = (pd.to_timedelta(days, unit='D')
+               + pd.to_timedelta(labels, unit='h'))
+    return pd.DatetimeIndex(pd.to_datetime(date_str) + offsets)
 
 
 def _add_date_column(df, date_str):
-    date_column = []
-    date = pd.to_datetime(date_str)
-    for index, _ in df.iterrows():
-        date_with_hour = date + pd.DateOffset(hours=index)
-        date_column.append(date_with_hour)
-
-        if (index + 1) % 24 == 0:
-            date += pd.DateOffset(days=1)
-    df['日期'] = date_column
+    df['日期'] = _hourly_timestamps(df.index, date_str)
     return df
 
 
-def get_weather_history_data(year=2018):
-    weather_history_data_path = f"drive/My Drive/taipei-weather-{year}/*.csv"
+def _reshape_air_df(df, date_column='監測日期', date_format=AIR_DATE_FORMAT):
+    # one row per (date, item) with 24 hour columns
+    # -> one row per hour with one column per item
+    item_column = df.columns[df.columns != date_column][0]
+    hour_columns = df.columns[-24:]
+
+    # an explicit format, the unit row defeats the format inference and
+    # every date would be parsed on its own
+    df = df.assign(**{
+        date_column: pd.to_datetime(df[date_column], format=date_format,
+                                    errors='coerce')
+    })
+    # remove redundant rows, e.g. the unit row below the header
+    df = df.dropna(subset=[date_column, item_column])
+
+    df = df.melt(id_vars=[date_column, item_column],
+                 value_vars=list(hour_columns),
+                 var_name='hour', value_name='value')
+    hours = df['hour'].map({
+        column: hour for hour, column in enumerate(hour_columns)
+    })
+    df['日期'] = df[date_column] + pd.to_timedelta(hours, unit='h')
+    df['value'] = pd.to_numeric(df['value'], errors='coerce')
+
+    air_df = (df.drop_duplicates(['日期', item_column], keep='last')
+                .pivot(index='日期', columns=item_column, values='value')
+                .sort_index())
+    air_df.columns.name = None
+
+    # imputation
+    return air_df.ffill()
+
+
+def get_weather_history_data(year=2018, data_dir=RAW_DATA_DIR,
+                             scheduler=None):
+    # dask is only needed here, most callers read the stores instead
+    import dask.dataframe as dd
+
+    weather_history_data_path = f"{data_dir}/taipei-weather-{year}/*.csv"
 
     col_names = [
         '氣溫(℃)',
@@ -30,7 +119,7 @@ def get_weather_history_data(year=2018):
         '降水量(mm)'
     ]
 
-    df = (dd.read_csv(
+    df = run_stage('weather.read_csv', lambda: dd.read_csv(
         weather_history_data_path,
         usecols=[3, 5, 6, 7, 10],
         header=0,
@@ -38,59 +127,32 @@ def get_weather_history_data(year=2018):
         na_values=['/', 'X', 'T', 'V', '...'],
         assume_missing=True
     )
-        .compute()
+        .compute(scheduler=scheduler)
     )
 
     # add datetime
-    df = _add_date_column(df, f"1/1/{year}")
+    df = run_stage('weather.date_column', _add_date_column,
+                   df, f"1/1/{year}")
 
     # set datetime as index
     df = df.set_index('日期')
 
     # imputation
-    df = df.fillna(method='ffill')
+    df = run_stage('weather.ffill', pd.DataFrame.ffill, df)
 
-    return df
+    return run_stage('weather.dtypes', optimize_dtypes,
+                     df, name=f"weather {year}")
 
 
-def get_air_history_data(year=2018):
-    air_history_data_path = f"drive/My Drive/taipei-air-{year}.csv"
+def get_air_history_data(year=2018, data_dir=RAW_DATA_DIR):
+    air_history_data_path = f"{data_dir}/taipei-air-{year}.csv"
 
     usecols_indices = [i for i in range(4, 30)]
-    df = (pd.read_csv(air_history_data_path,
-                      usecols=usecols_indices,
-                      na_values=['x']))
-    # remove redundant rows
-    df = df.iloc[1:2969]
-
-    # reverse order, since 12/31 is the first row, 1/1 is the last row
-    df['監測日期'] = pd.to_datetime(df['監測日期'])
-    df = df.sort_values('監測日期')
-
-    # imputation
-    df = df.fillna(method='ffill')
-
-    df = df.set_index('監測日期')
+    df = run_stage('air.read_csv', pd.read_csv, air_history_data_path,
+                   usecols=usecols_indices, na_values=['x'])
 
     # make air_df
-    date_range = pd.date_range(start=f"1/1/{year}", end=f"6/15/{year}")
-    air_df = pd.DataFrame()
-    for date in date_range:
-        date_str = str(date).split(' ')[0]
-        if date_str in df.index:
-            sub_df = df.loc[date_str].T
-            headers = sub_df.iloc[0]
-            sub_df = pd.DataFrame(sub_df.values[1:], columns=headers)
-
-            # add datetime
-            sub_df = _add_date_column(sub_df, date_str)
-
-            if air_df.empty:
-                air_df = sub_df
-            else:
-                air_df = pd.concat([air_df, sub_df], sort=True)
-
-    air_df = air_df.set_index('日期')
+    air_df = run_stage('air.reshape', _reshape_air_df, df)
 
     mapper = {
         '小時風向值  ()': '小時風向值',
@@ -129,95 +191,240 @@ def get_air_history_data(year=2018):
         '二氧化硫(ppb)',
         '臭氧(ppb)'
     ]
-    return air_df[usecols]
+    return run_stage('air.dtypes', optimize_dtypes,
+                     air_df[usecols], name=f"air {year}")
+
+
+def get_weather_air_history_data(year=2018, data_dir=RAW_DATA_DIR):
+    weather_df = get_weather_history_data(year=year, data_dir=data_dir)
+    air_df = get_air_history_data(year=year, data_dir=data_dir)
 
+    return _join_weather_air(weather_df, air_df)
 
-def get_weather_air_history_data(year=2018):
-    weather_df = get_weather_history_data(year=year)
-    air_df = get_air_history_data(year=year)
 
-    weather_air_df = pd.concat([air_df, weather_df], axis=1, sort=True)
-    weather_air_df = weather_air_df.fillna(method='ffill')
+def _join_weather_air(weather_df, air_df):
+    weather_air_df = run_stage('weather_air.concat', pd.concat,
+                               [air_df, weather_df], axis=1, sort=True)
+    weather_air_df = run_stage('weather_air.ffill', pd.DataFrame.ffill,
+                               weather_air_df)
 
     return weather_air_df
 
 
-def get_youbike_history_data(stop_no=None):
-    FILE_PATHS = [
-        'drive/My Drive/youbike-history-data-1.csv.zip',
-        'drive/My Drive/youbike-history-data-2.csv.zip'
-    ]
+YOUBIKE_FIELDS_LIST = [
+    'stop_no',
+    'stop_name',
+    'total_number',
+    'current_number',
+    'stop_area',
+    'update_time',
+    'lat',
+    'lng',
+    'address',
+    'stop_area_en',
+    'stop_name_en',
+    'address_en',
+    'vacancy_number',
+    'status',
+    'batch_update_time',
+    'db_update_time',
+    'update_info_time',
+    'update_info_date'
+]
+
+YOUBIKE_FIELDS_TO_KEEP = [
+    'stop_no',
+    'stop_name',
+    'stop_area',
+    'lat',
+    'lng',
+    'total_number',
+    'current_number',
+    'vacancy_number',
+    'status',
+    'db_update_time'
+]
+
+
+def _concat_chunks(chunks, columns, dtypes):
+    # pd.concat falls back to object dtype when categories differ,
+    # so align every categorical column to the union of categories first
+    if not chunks:
+        return pd.DataFrame(columns=columns).astype(dtypes)
+
+    for column in columns:
+        if isinstance(chunks[0][column].dtype, pd.CategoricalDtype):
+            categories = union_categoricals(
+                [chunk[column] for chunk in chunks]).categories
+            chunks = [
+                chunk.assign(**{
+                    column: chunk[column].cat.set_categories(categories)
+                })
+                for chunk in chunks
+            ]
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_youbike_history_chunks(file_paths, stop_no=None, chunksize=500000,
+                                since=None):
+    '''
+    file_paths: youbike history csv(.zip) files
+    stop_no: keep only this station (or list of stations)
+    chunksize: rows parsed per chunk, bounds the peak memory
+    since: keep only rows updated after this datetime
+    '''
+    if stop_no is not None and not np.isscalar(stop_no):
+        stop_no = list(stop_no)
+
+    for file_path in file_paths:
+        reader = pd.read_csv(
+            file_path,
+            names=YOUBIKE_FIELDS_LIST,
+            usecols=YOUBIKE_FIELDS_TO_KEEP,
+            dtype=YOUBIKE_DTYPES,
+            parse_dates=['db_update_time'],
+            chunksize=chunksize
+        )
+        for chunk in reader:
+            mask = chunk['status'] == 1  # enabled
+            if isinstance(stop_no, list):
+                mask &= chunk['stop_no'].isin(stop_no)
+            elif stop_no is not None:
+                mask &= chunk['stop_no'] == stop_no
+            if since is not None:
+                mask &= chunk['db_update_time'] > since
+            chunk = chunk[mask]
+            if len(chunk):
+                yield chunk[YOUBIKE_FIELDS_TO_KEEP]
+
+
+def _sort_by_station_time(df):
+    # one lexsort over both keys instead of sorting each station group
+    order = np.lexsort((df['db_update_time'].values, df['stop_no'].values))
+    return df.take(order).set_index(['stop_no', 'db_update_time'])
+
+
+def get_station_offsets(df):
+    '''
+    df: dataframe indexed by sorted (stop_no, db_update_time)
+    returns start/stop row positions of every station, indexed by stop_no
+    '''
+    stops = df.index.get_level_values('stop_no').values
+    boundaries = np.flatnonzero(stops[1:] != stops[:-1]) + 1
+    starts = np.concatenate([[0], boundaries]) if len(stops) else boundaries
+    ends = np.concatenate([boundaries, [len(stops)]]) if len(stops) else []
+    return pd.DataFrame(
+        {'start': starts, 'stop': ends},
+        index=pd.Index(stops[starts], name='stop_no')
+    )
 
-    FIELDS_LIST = [
-        'stop_no', 
-        'stop_name', 
-        'total_number', 
-        'current_number', 
-        'stop_area', 
-        'update_time', 
-        'lat', 
-        'lng', 
-        'address', 
-        'stop_area_en', 
-        'stop_name_en',
-        'address_en',
-        'vacancy_number',
-        'status',
-        'batch_update_time',
-        'db_update_time',
-        'update_info_time',
-        'update_info_date'
-    ]
 
-    FIELDS_TO_KEEP = [
-        'stop_no',
-        'stop_name',
-        'stop_area',
-        'lat',
-        'lng',
-        'total_number',
-        'current_number',
-        'vacancy_number',
-        'status',
-        'db_update_time'
+def get_station_df(df, offsets, stop_no):
+    '''
+    df: dataframe indexed by sorted (stop_no, db_update_time)
+    offsets: station offsets of df, see get_station_offsets
+    stop_no: station to slice
+    '''
+    start, stop = offsets.loc[stop_no]
+    return df.iloc[start:stop]
+
+
+def _make_youbike_df(chunks):
+    df = run_stage('youbike.concat', _concat_chunks,
+                   chunks, YOUBIKE_FIELDS_TO_KEEP,
+                   dict(YOUBIKE_DTYPES, db_update_time='datetime64[ns]'))
+    df['weekday'] = df['db_update_time'].dt.weekday.astype('int8')
+    df['is_weekend'] = df['weekday'] >= 5
+    return run_stage('youbike.dtypes', optimize_dtypes, df, name='youbike')
+
+
+def get_youbike_history_data(stop_no=None, chunksize=500000,
+                             data_dir=RAW_DATA_DIR, with_offsets=False):
+    FILE_PATHS = [
+        f"{data_dir}/youbike-history-data-1.csv.zip",
+        f"{data_dir}/youbike-history-data-2.csv.zip"
     ]
 
-    read_csv_func = partial(pd.read_csv, names=FIELDS_LIST)
-    df = pd.concat(map(read_csv_func, FILE_PATHS), sort=True)
-    df = df[FIELDS_TO_KEEP]
-    df['db_update_time'] = pd.to_datetime(df['db_update_time'])
-    df = df[df['status'] == 1] # enabled
-    df['weekday'] = df['db_update_time'].dt.weekday
-    df['is_weekend'] = (df['weekday'] == 5) | (df['weekday'] == 6)
-
-    if stop_no:
-        df = (df[df['stop_no'] == stop_no]
-                .sort_values('db_update_time')
+    chunks = run_stage('youbike.read_csv', lambda: list(
+        read_youbike_history_chunks(FILE_PATHS, stop_no=stop_no,
+                                    chunksize=chunksize)))
+    df = _make_youbike_df(chunks)
+
+    if stop_no and np.isscalar(stop_no):
+        df = (df.sort_values('db_update_time')
                 .set_index('db_update_time'))
     else:
-        df = (df.groupby('stop_no')
-                .apply(pd.DataFrame.sort_values, 'db_update_time')
-                .set_index(['stop_no', 'db_update_time']))
+        df = run_stage('youbike.sort', _sort_by_station_time, df)
+        if with_offsets:
+            return df, get_station_offsets(df)
 
     return df
 
 
-def get_weather_air_df(path='drive/My Drive/1.0-weather-air-history-data-taipei-df.pkl'):
-    return pd.read_pickle(path)
-
-
-def get_youbike_df(path='drive/My Drive/1.0-youbike-history-data-186-df.pkl'):
-    return pd.read_pickle(path)
+def get_weather_air_df(path=WEATHER_AIR_STORE_PATH, columns=None,
+                       start=None, end=None):
+    '''
+    path: parquet store, or a pickled dataframe (read whole)
+    columns: columns to read, None reads all
+    start: start datetime included
+    end: end datetime included
+    '''
+    if str(path).endswith('.pkl'):
+        return optimize_dtypes(pd.read_pickle(path), name=str(path))
+    return read_weather_air_store(path, columns=columns,
+                                  start=start, end=end)
 
 
-def get_youbike_integration_df(youbike_df=None, weather_air_df=None):
-    if not youbike_df:
+def get_youbike_df(path=YOUBIKE_STORE_PATH, stop_no=None, columns=None,
+                   start=None, end=None):
+    '''
+    path: parquet store, or a pickled dataframe (read whole)
+    stop_no: a station or a list of stations, None reads all of them
+    columns: columns to read, None reads all
+    start: start datetime included
+    end: end datetime included
+    '''
+    if str(path).endswith('.pkl'):
+        return optimize_dtypes(pd.read_pickle(path), name=str(path))
+    return read_youbike_store(path, stop_no=stop_no, columns=columns,
+                              start=start, end=end)
+
+
+def _merge_asof_time(youbike_df, weather_air_df, by=None, tolerance=None,
+                     time_column='db_update_time'):
+    # every youbike row gets the latest weather/air row at or before it
+    index_names = list(youbike_df.index.names)
+    left = (youbike_df.reset_index()
+                      .sort_values(time_column, kind='mergesort'))
+    right = weather_air_df.reset_index()
+    right = (right.rename(columns={right.columns[0]: time_column})
+                  .sort_values(time_column, kind='mergesort'))
+    if tolerance is not None:
+        tolerance = pd.Timedelta(tolerance)
+
+    df = pd.merge_asof(left, right, on=time_column, by=by,
+                       tolerance=tolerance, direction='backward')
+    if len(index_names) > 1:
+        df = df.sort_values(index_names, kind='mergesort')
+    return df.set_index(index_names)
+
+
+def get_youbike_integration_df(youbike_df=None, weather_air_df=None,
+                               by=None, tolerance=None):
+    '''
+    youbike_df: youbike dataframe, single or multiple stations
+    weather_air_df: hourly weather and air dataframe
+    by: key column present in both frames, ex: stop_no for per-station
+        weather readings
+    tolerance: max age of the matched weather reading, ex: '2H'
+    '''
+    if youbike_df is None:
         youbike_df = get_youbike_df()
-    if not weather_air_df:
+    if weather_air_df is None:
         weather_air_df = get_weather_air_df()
 
     # merge two dataframes and do some preprocessings
-    # - imputation
+    # - as-of join on time, which also imputes the weather/air values
     # - filter out redundant fields
     # - rename columns
     fields_needed = [
@@ -246,25 +453,365 @@ def get_youbike_integration_df(youbike_df=None, weather_air_df=None):
         'is_weekend': '是否為週末'
     }
 
-    df = (pd.merge(youbike_df, weather_air_df,
-                   how='outer', left_index=True,
-                   right_index=True, sort=True)
+    df = (run_stage('integration.merge_asof', _merge_asof_time,
+                    youbike_df, weather_air_df, by=by, tolerance=tolerance)
             .rename(columns=rename_mapper)
           )
 
-    df[fields_needed[1:]] = df[fields_needed[1:]].fillna(method='ffill')
-    df = df.dropna() # remove rows with NaN inside the column of 可借車數
-
-    # weekday mapper
-    weekday_dict = {
-        0.0: 'Mon',
-        1.0: 'Tue',
-        2.0: 'Wed',
-        3.0: 'Thu',
-        4.0: 'Fri',
-        5.0: 'Sat',
-        6.0: 'Sun'
+    # remove rows without any weather/air reading before them
+    df = run_stage('integration.dropna', pd.DataFrame.dropna, df,
+                   subset=fields_needed)
+
+    df['星期幾'] = weekday_categorical(df['星期幾'])
+
+    return run_stage('integration.dtypes', optimize_dtypes,
+                     df[fields_needed], name='integration')
+
+
+def _iter_csv_blocks(file_path, block_size=YOUBIKE_BLOCK_SIZE):
+    # line-aligned blocks of the csv bytes of a file, or of the only file
+    # of a zip, decompressed one block at a time
+    if str(file_path).endswith('.zip'):
+        with zipfile.ZipFile(file_path) as archive:
+            f = archive.open(archive.namelist()[0])
+    else:
+        f = open(file_path, 'rb')
+
+    with f:
+        rest = b''
+        while True:
+            data = f.read(block_size)
+            if not data:
+                break
+            data = rest + data
+            end = data.rfind(b'\n') + 1
+            if end:
+                yield data[:end]
+            rest = data[end:]
+        if rest:
+            yield rest
+
+
+def _build_youbike_block(block, stop_no, chunksize, store_path, cube_path):
+    chunks = run_stage('youbike.read_csv', lambda: list(
+        read_youbike_history_chunks([io.BytesIO(block)], stop_no=stop_no,
+                                    chunksize=chunksize)))
+    df = _make_youbike_df(chunks)
+    if not len(df):
+        return 0, None
+    run_stage('youbike.write_store', write_youbike_store, df, store_path)
+    # buckets split across blocks are merged when the cube is compacted
+    run_stage('cube.update', update_cube, df, cube_path)
+    return len(df), df['db_update_time'].max()
+
+
+def _store_paths(output_dir):
+    output_dir = Path(output_dir)
+    return {
+        source: output_dir / Path(path).name
+        for source, path in [('youbike', YOUBIKE_STORE_PATH),
+                             ('weather_air', WEATHER_AIR_STORE_PATH),
+                             ('integration', INTEGRATION_STORE_PATH),
+                             ('cube', CUBE_STORE_PATH),
+                             ('matrix', MATRIX_STORE_PATH)]
     }
-    df['星期幾'] = df['星期幾'].apply(lambda weekday: weekday_dict[weekday]).astype('category')
 
-    return df[fields_needed]
+
+def _read_state(output_dir):
+    state_path = Path(output_dir) / STATE_FILE_NAME
+    if not state_path.exists():
+        return {}
+    with open(state_path) as f:
+        return {source: pd.Timestamp(mark)
+                for source, mark in json.load(f).items()}
+
+
+def _write_state(output_dir, state):
+    with open(Path(output_dir) / STATE_FILE_NAME, 'w') as f:
+        json.dump({source: str(mark) for source, mark in state.items()},
+                  f, indent=2)
+
+
+def _update_mark(state, source, mark):
+    if pd.notna(mark) and (source not in state or mark > state[source]):
+        state[source] = mark
+
+
+def _append_weather_air(weather_air_df, path, state):
+    # a joined row is final once both sources reached it, later rows
+    # wait for the next update
+    until = min(state['weather'], state['air'])
+    since = state.get('weather_air')
+    weather_air_df = weather_air_df[weather_air_df.index <= until]
+
+    if since is not None:
+        # carry the forward-fill state across the previous update
+        previous_df = read_weather_air_store(path, start=since)
+        weather_air_df = weather_air_df[weather_air_df.index > since]
+        weather_air_df = (pd.concat([previous_df, weather_air_df])
+                            .ffill()
+                            .iloc[len(previous_df):])
+
+    if len(weather_air_df):
+        write_weather_air_store(weather_air_df, path)
+        state['weather_air'] = weather_air_df.index.max()
+    return len(weather_air_df)
+
+
+def _integrate_stations(paths, stations, since, until, weather_air_df):
+    # integrate the new youbike rows of a batch of stations, run in the
+    # workers
+    youbike_df = read_youbike_store(paths['youbike'], stop_no=stations,
+                                    start=since, end=until)
+    times = youbike_df.index.get_level_values('db_update_time')
+    mask = times < until
+    if since is not None:
+        mask &= times > since
+    youbike_df = youbike_df[mask]
+    if not len(youbike_df):
+        return 0, None
+
+    df = get_youbike_integration_df(youbike_df, weather_air_df)
+    write_integration_store(df, paths['integration'])
+    return len(df), times[mask].max()
+
+
+def _append_integration(paths, state, lookback='1D', executor=None,
+                        batch_size=INTEGRATION_BATCH_SIZE):
+    # integrate the youbike rows covered by a final weather/air reading,
+    # a batch of stations at a time
+    if 'youbike' not in state or 'weather_air' not in state:
+        return 0
+    since = state.get('integration')
+    until = state['weather_air'] + pd.Timedelta(hours=1)
+    first = since if since is not None else read_time_bounds(
+        paths['youbike'])[0]
+    # hourly rows, small enough to be read once and sent to every batch
+    weather_air_df = read_weather_air_store(
+        paths['weather_air'], start=first - pd.Timedelta(lookback))
+
+    stations = list_stations(paths['youbike'])
+    batches = [(paths, stations[i:i + batch_size], since, until,
+                weather_air_df)
+               for i in range(0, len(stations), batch_size)]
+    if executor is None:
+        results = [_integrate_stations(*batch) for batch in batches]
+    else:
+        results = [collect(future) for future in [
+            submit(executor, _integrate_stations, *batch)
+            for batch in batches]]
+
+    marks = [mark for _, mark in results if mark is not None]
+    if marks:
+        state['integration'] = max(marks)
+    return sum(rows for rows, _ in results)
+
+
+def _write_parsed(futures, parsed, state, paths):
+    # wait for one of the futures of build_dataset and write every
+    # partition as soon as its inputs are parsed
+    logger = logging.getLogger(__name__)
+    done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+    for future in done:
+        source, key = futures.pop(future)
+        if source == 'youbike':
+            _, mark = collect(future)
+            _update_mark(state, 'youbike', mark)
+            continue
+
+        parsed[source, key] = collect(future)
+        _update_mark(state, source, parsed[source, key].index.max())
+        if ('weather', key) in parsed and ('air', key) in parsed:
+            weather_air_df = _join_weather_air(parsed.pop(('weather', key)),
+                                               parsed.pop(('air', key)))
+            run_stage('weather_air.write_store', write_weather_air_store,
+                      weather_air_df, paths['weather_air'])
+            _update_mark(state, 'weather_air', weather_air_df.index.max())
+            logger.info(f"wrote {len(weather_air_df)} weather and air "
+                        f"rows of {key}")
+
+
+def build_dataset(data_dir, output_dir, years=(2018,), stop_no=None,
+                  workers=None, chunksize=500000,
+                  block_size=YOUBIKE_BLOCK_SIZE):
+    '''
+    data_dir: raw data directory
+    output_dir: processed data directory, its stores are rebuilt from scratch
+    years: weather and air years to build
+    stop_no: a station or a list of stations, None builds all of them
+    workers: worker processes, defaults to the number of cpus
+    chunksize: rows parsed per chunk of the youbike history zips
+    block_size: uncompressed bytes of the youbike history zips parsed per
+                task, the zips are split into blocks across the workers
+    '''
+    logger = logging.getLogger(__name__)
+    paths = _store_paths(output_dir)
+    for path in paths.values():
+        shutil.rmtree(path, ignore_errors=True)
+    state = {}
+    workers = workers or os.cpu_count()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        parsed = {}
+
+        for year in years:
+            # one dask scheduler per worker process is enough
+            futures[submit(
+                executor, get_weather_history_data, year, data_dir,
+                'synchronous'
+            )] = ('weather', year)
+            futures[submit(
+                executor, get_air_history_data, year, data_dir
+            )] = ('air', year)
+
+        # the zips are decompressed here and parsed by the workers, a
+        # few blocks per worker are in flight to bound the memory
+        for file_path in sorted(Path(data_dir).glob(YOUBIKE_FILE_PATTERN)):
+            for block in _iter_csv_blocks(file_path, block_size):
+                futures[submit(
+                    executor, _build_youbike_block, block, stop_no,
+                    chunksize, str(paths['youbike']), str(paths['cube'])
+                )] = ('youbike', file_path.name)
+                while len(futures) >= 2 * workers:
+                    _write_parsed(futures, parsed, state, paths)
+            logger.info(f"sent the youbike blocks of {file_path.name}")
+        while futures:
+            _write_parsed(futures, parsed, state, paths)
+
+        # every block wrote one file per partition it covered
+        files = run_stage('youbike.compact', compact_parquet_store,
+                          paths['youbike'], 'db_update_time',
+                          executor=executor)
+        files += run_stage('cube.compact', compact_cube, paths['cube'],
+                           executor=executor)
+        logger.info(f"compacted {files} youbike and cube files")
+
+        shape = run_stage('matrix.write', write_matrix,
+                          paths['youbike'], paths['matrix'])
+        logger.info(f"wrote the {shape[0]} x {shape[1]} availability "
+                    f"matrix")
+
+        rows = run_stage('integration.append', _append_integration,
+                         paths, state, executor=executor)
+        logger.info(f"wrote {rows} integration rows")
+    _write_state(output_dir, state)
+
+
+def update_dataset(data_dir, output_dir, years=(2018,), stop_no=None,
+                   chunksize=500000):
+    '''
+    data_dir: raw data directory
+    output_dir: processed data directory made by build_dataset
+    years: weather and air years to look for new rows in
+    stop_no: a station or a list of stations, None updates all of them
+    chunksize: rows parsed per chunk of the youbike history zips
+
+    Only rows newer than the high-water mark of their source are parsed,
+    integrated and appended to the stores.
+    '''
+    logger = logging.getLogger(__name__)
+    paths = _store_paths(output_dir)
+    state = _read_state(output_dir)
+
+    chunks = run_stage('youbike.read_csv', lambda: list(
+        read_youbike_history_chunks(
+            sorted(Path(data_dir).glob(YOUBIKE_FILE_PATTERN)),
+            stop_no=stop_no, chunksize=chunksize,
+            since=state.get('youbike'))))
+    youbike_df = _make_youbike_df(chunks)
+    if len(youbike_df):
+        run_stage('youbike.write_store', write_youbike_store,
+                  youbike_df, paths['youbike'])
+        run_stage('cube.update', update_cube, youbike_df, paths['cube'])
+        _update_mark(state, 'youbike', youbike_df['db_update_time'].max())
+    logger.info(f"appended {len(youbike_df)} youbike rows")
+    if len(youbike_df) or not paths['matrix'].exists():
+        # only the slots of the new rows are written, the matrix is
+        # rebuilt from the store when they do not fit in it
+        shape = run_stage('matrix.update', update_matrix,
+                          youbike_df, paths['matrix'])
+        if shape is None:
+            shape = run_stage('matrix.write', write_matrix,
+                              paths['youbike'], paths['matrix'])
+            logger.info(f"rewrote the {shape[0]} x {shape[1]} "
+                        f"availability matrix")
+        else:
+            logger.info(f"updated the {shape[0]} x {shape[1]} "
+                        f"availability matrix")
+
+    for year in years:
+        if 'weather_air' in state and year < state['weather_air'].year:
+            continue
+        weather_df = get_weather_history_data(year, data_dir)
+        air_df = get_air_history_data(year, data_dir)
+        _update_mark(state, 'weather', weather_df.index.max())
+        _update_mark(state, 'air', air_df.index.max())
+        rows = run_stage('weather_air.append', _append_weather_air,
+                         _join_weather_air(weather_df, air_df),
+                         paths['weather_air'], state)
+        logger.info(f"appended {rows} weather and air rows of {year}")
+
+    rows = run_stage('integration.append', _append_integration,
+                     paths, state)
+    logger.info(f"appended {rows} integration rows")
+    _write_state(output_dir, state)
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True))
+@click.argument('output_filepath', type=click.Path())
+@click.option('--year', 'years', type=int, multiple=True, default=[2018],
+              show_default=True, help='Year to build, can be repeated.')
+@click.option('--stop-no', type=int, multiple=True,
+              help='Station to keep, can be repeated. '
+                   'All stations by default.')
+@click.option('--workers', type=int, default=None,
+              help='Worker processes, defaults to the number of cpus.')
+@click.option('--chunksize', type=int, default=500000, show_default=True)
+@click.option('--incremental', is_flag=True,
+              help='Only append rows newer than the last build or update.')
+@click.option('--instrument', 'instrumented', is_flag=True,
+              help='Log wall time, rows and peak memory of every stage.')
+@click.option('--profile-stage',
+              help='Stage to profile, ex: weather.read_csv. '
+                   'Implies --instrument.')
+@click.option('--profiler', type=click.Choice(['cprofile', 'sample']),
+              default='cprofile', show_default=True)
+def main(input_filepath, output_filepath, years, stop_no, workers,
+         chunksize, incremental, instrumented, profile_stage, profiler):
+    """ Runs data processing scripts to turn raw data from (../raw) into
+        parquet stores ready to be analyzed (saved in ../processed).
+    """
+    logger = logging.getLogger(__name__)
+    if not (instrumented or profile_stage):
+        _make_dataset(input_filepath, output_filepath, years, stop_no,
+                      workers, chunksize, incremental)
+        return
+
+    with instrument(profile_stage=profile_stage,
+                    profiler=profiler) as report:
+        _make_dataset(input_filepath, output_filepath, years, stop_no,
+                      workers, chunksize, incremental)
+    report.log(logger)
+
+
+def _make_dataset(input_filepath, output_filepath, years, stop_no, workers,
+                  chunksize, incremental):
+    logger = logging.getLogger(__name__)
+    if incremental:
+        logger.info('updating final data set from raw data')
+        update_dataset(input_filepath, output_filepath, years=years,
+                       stop_no=list(stop_no) or None, chunksize=chunksize)
+        return
+
+    logger.info('making final data set from raw data')
+    build_dataset(input_filepath, output_filepath, years=years,
+                  stop_no=list(stop_no) or None, workers=workers,
+                  chunksize=chunksize)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
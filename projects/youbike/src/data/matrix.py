@@ -0,0 +1,238 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data.store import (
+    MATRIX_STORE_PATH, YOUBIKE_STORE_PATH, read_youbike_store
+)
+
+
+MATRIX_COLUMNS = ['current_number', 'vacancy_number']
+MATRIX_FREQ = '5min'
+INDEX_FILE_NAME = 'index.json'
+MASK_FILE_NAME = 'mask.npy'
+
+
+def _store_layout(store_path):
+    # stations and months from the partition directories, no file is read
+    stations, months = set(), set()
+    for month_dir in Path(store_path).glob('stop_no=*/month=*'):
+        stations.add(int(month_dir.parent.name.split('=', 1)[1]))
+        months.add(month_dir.name.split('=', 1)[1])
+    return sorted(stations), sorted(months)
+
+
+def _month_end(time):
+    # start of the month after time
+    return (pd.Timestamp(time).normalize().replace(day=1)
+            + pd.DateOffset(months=1))
+
+
+def _write_index(path, index):
+    # replaced in one step, a reader never sees a partial file
+    tmp_path = path / f".{INDEX_FILE_NAME}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(tmp_path, path / INDEX_FILE_NAME)
+
+
+def write_matrix(store_path=YOUBIKE_STORE_PATH, path=MATRIX_STORE_PATH,
+                 columns=MATRIX_COLUMNS, freq=MATRIX_FREQ, batch_size=64,
+                 spare_months=12):
+    '''
+    store_path: youbike store the matrix is built from
+    path: matrix directory, replaced as a whole
+    columns: columns to keep, one stations x slots .npy file each
+    freq: slot width, the last reading of a station in a slot is kept
+    batch_size: stations read from the store at a time, bounds the memory
+    spare_months: months of empty slots allocated after the store, filled
+                  in place by update_matrix
+
+    The grid covers the whole months of the store. Slots without a
+    reading are 0 and False in mask.npy.
+    '''
+    stations, months = _store_layout(store_path)
+    origin = pd.Timestamp(months[0]) if months else pd.Timestamp(0)
+    end = _month_end(months[-1]) if months else origin
+    step = pd.Timedelta(freq).value
+    n_slots = (end - origin).value // step
+    capacity = (end + pd.DateOffset(months=spare_months)
+                - origin).value // step
+
+    # written next to the current matrix and swapped in, processes that
+    # opened the old files keep reading them
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    # the spare slots are never written, they stay holes of the files
+    shape = (len(stations), capacity)
+    values = {column: np.lib.format.open_memmap(
+        tmp_path / f"{column}.npy", mode='w+', dtype='int16', shape=shape)
+        for column in columns}
+    mask = np.lib.format.open_memmap(tmp_path / MASK_FILE_NAME, mode='w+',
+                                     dtype='bool', shape=shape)
+
+    index = pd.Index(stations)
+    for i in range(0, len(stations), batch_size):
+        df = read_youbike_store(store_path, stop_no=stations[i:i + batch_size],
+                                columns=columns)
+        rows = index.get_indexer(df.index.get_level_values('stop_no'))
+        slots = ((df.index.get_level_values('db_update_time').asi8
+                  - origin.value) // step)
+        _fill_slots(values, mask, df, rows, slots, columns)
+
+    for array in [*values.values(), mask]:
+        array.flush()
+    _write_index(tmp_path, {'stations': stations,
+                            'origin': origin.isoformat(), 'freq': freq,
+                            'slots': n_slots, 'capacity': capacity,
+                            'columns': columns})
+
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+    return len(stations), n_slots
+
+
+def _fill_slots(values, mask, df, rows, slots, columns):
+    # rows are sorted by station and time, keep the last of a slot
+    flat = rows.astype('int64') * mask.shape[1] + slots
+    last = np.r_[flat[1:] != flat[:-1], True]
+    rows, slots = rows[last], slots[last]
+    for column in columns:
+        values[column][rows, slots] = df[column].values[last]
+    mask[rows, slots] = True
+
+
+def update_matrix(df, path=MATRIX_STORE_PATH):
+    '''
+    df: new youbike rows, indexed by (stop_no, time) or with stop_no and
+        db_update_time columns
+    path: matrix directory made by write_matrix
+
+    Writes the slots of the new rows in place, in the spare slots
+    allocated by write_matrix. Returns the new shape, or None if the
+    matrix has to be rebuilt: it does not exist, a station is new or a
+    row falls outside the allocated slots.
+    '''
+    path = Path(path)
+    if not (path / INDEX_FILE_NAME).exists():
+        return None
+    with open(path / INDEX_FILE_NAME) as f:
+        index = json.load(f)
+    if not len(df):
+        return len(index['stations']), index['slots']
+    if 'db_update_time' in df.columns:
+        df = df.set_index(['stop_no', 'db_update_time'])
+    df = df.sort_index(kind='mergesort')
+
+    capacity = index.get('capacity', index['slots'])
+    origin = pd.Timestamp(index['origin'])
+    times = df.index.get_level_values('db_update_time')
+    rows = pd.Index(index['stations']).get_indexer(
+        df.index.get_level_values('stop_no'))
+    slots = (times.asi8 - origin.value) // pd.Timedelta(index['freq']).value
+    n_slots = max(index['slots'], (_month_end(times.max()) - origin)
+                  // pd.Timedelta(index['freq']))
+    if (rows < 0).any() or slots.min() < 0 or n_slots > capacity:
+        return None
+
+    values = {column: np.load(path / f"{column}.npy", mmap_mode='r+')
+              for column in index['columns']}
+    mask = np.load(path / MASK_FILE_NAME, mmap_mode='r+')
+    _fill_slots(values, mask, df, rows, slots, index['columns'])
+    for array in [*values.values(), mask]:
+        array.flush()
+    # readers only see the new slots once the index says they are filled
+    _write_index(path, dict(index, slots=int(n_slots)))
+    return len(index['stations']), int(n_slots)
+
+
+class AvailabilityMatrix:
+    '''
+    Stations x time slots arrays of a matrix directory, memory-mapped
+    read-only so any number of processes share the same pages.
+    '''
+
+    def __init__(self, path=MATRIX_STORE_PATH):
+        path = Path(path)
+        with open(path / INDEX_FILE_NAME) as f:
+            index = json.load(f)
+        self.stations = pd.Index(index['stations'], name='stop_no')
+        self.origin = pd.Timestamp(index['origin'])
+        self.freq = pd.Timedelta(index['freq'])
+        self.columns = index['columns']
+        # the files also hold the spare slots of later updates
+        filled = slice(0, index['slots'])
+        self.values = {column: np.load(path / f"{column}.npy",
+                                       mmap_mode='r')[:, filled]
+                       for column in self.columns}
+        self.mask = np.load(path / MASK_FILE_NAME, mmap_mode='r')[:, filled]
+
+    @property
+    def shape(self):
+        return self.mask.shape
+
+    def slots(self, start=None, end=None):
+        '''
+        start: start datetime included
+        end: end datetime included
+
+        returns the slice of the slots between start and end
+        '''
+        first = 0 if start is None else max(
+            -((self.origin - pd.Timestamp(start)) // self.freq), 0)
+        last = self.shape[1] if end is None else min(
+            (pd.Timestamp(end) - self.origin) // self.freq + 1,
+            self.shape[1])
+        return slice(first, max(last, first))
+
+    def times(self, start=None, end=None):
+        window = self.slots(start, end)
+        return pd.date_range(self.origin + window.start * self.freq,
+                             periods=window.stop - window.start,
+                             freq=self.freq, name='db_update_time')
+
+    def select(self, stop_no=None, start=None, end=None,
+               column=MATRIX_COLUMNS[0]):
+        '''
+        stop_no: a station, a list of stations or None for all of them
+        start: start datetime included
+        end: end datetime included
+        column: one of the columns
+
+        returns the values and the mask, views of the files unless a list
+        of stations is given
+        '''
+        window = self.slots(start, end)
+        if stop_no is None:
+            rows = slice(None)
+        elif np.isscalar(stop_no):
+            rows = self.stations.get_loc(stop_no)
+        else:
+            rows = self.stations.get_indexer(stop_no)
+            if (rows < 0).any():
+                raise KeyError(f"Unknown stations: "
+                               f"{list(np.asarray(stop_no)[rows < 0])}")
+        return self.values[column][rows, window], self.mask[rows, window]
+
+    def to_frame(self, stop_no=None, start=None, end=None,
+                 column=MATRIX_COLUMNS[0]):
+        '''
+        returns a copy indexed by time with one column per station and
+        NaN for missing readings, see select
+        '''
+        values, mask = self.select(stop_no, start, end, column)
+        values = np.where(mask, values, np.nan).astype('float32')
+        stations = (self.stations if stop_no is None
+                    else pd.Index(np.atleast_1d(stop_no), name='stop_no'))
+        return pd.DataFrame(np.atleast_2d(values).T,
+                            index=self.times(start, end), columns=stations)
+
+
+def open_matrix(path=MATRIX_STORE_PATH):
+    return AvailabilityMatrix(path)
@@ -0,0 +1,253 @@
+import cProfile
+import io
+import json
+import logging
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+import traceback
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import pandas as pd
+
+
+# the report of the running instrument() block, None when disabled
+_REPORT = ContextVar('stage_report', default=None)
+
+
+def _rows(value):
+    # rows of a frame, or of a list of frames
+    if hasattr(value, 'shape'):
+        return len(value)
+    if isinstance(value, (list, tuple)) and value and all(
+            hasattr(item, 'shape') for item in value):
+        return sum(len(item) for item in value)
+    return None
+
+
+class SamplingProfiler:
+    '''
+    Samples the stack of one thread every interval seconds and counts
+    the functions seen, without the per-call overhead of cProfile.
+    '''
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = 0
+        self.counts = Counter()
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            seen = {(f.filename, f.lineno, f.name)
+                    for f in traceback.extract_stack(frame)}
+            self.counts.update(seen)
+
+    def enable(self):
+        self._sampler.start()
+
+    def disable(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def summary(self, limit=30):
+        lines = [f"{self.samples} samples every {self.interval} s"]
+        for (filename, lineno, name), count in self.counts.most_common(
+                limit):
+            lines.append(f"{count / max(self.samples, 1):6.1%}  "
+                         f"{name} ({filename}:{lineno})")
+        return '\n'.join(lines)
+
+
+class StageReport:
+    '''
+    Wall time, rows in and out and peak traced memory of every stage run
+    inside an instrument() block, and the profile of one stage.
+    '''
+
+    def __init__(self, profile_stage=None, profiler='cprofile',
+                 trace_memory=True):
+        '''
+        profile_stage: name of the stage to profile, None profiles none
+        profiler: cprofile or sample
+        trace_memory: trace the peak memory of every stage
+        '''
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        self.trace_memory = trace_memory
+        self.stages = []
+        self.profiles = {}
+        self._peaks = []
+        self._started_tracing = False
+
+    @property
+    def options(self):
+        return {'profile_stage': self.profile_stage,
+                'profiler': self.profiler,
+                'trace_memory': self.trace_memory}
+
+    def merge(self, stages, profiles):
+        self.stages.extend(stages)
+        self.profiles.update(profiles)
+
+    def _make_profiler(self, name):
+        if name != self.profile_stage:
+            return None
+        if self.profiler == 'sample':
+            return SamplingProfiler()
+        if self.profiler == 'cprofile':
+            return cProfile.Profile()
+        raise ValueError(f"Unrecognized profiler: {self.profiler}")
+
+    def _profile_text(self, profiler):
+        if isinstance(profiler, SamplingProfiler):
+            return profiler.summary()
+        stream = io.StringIO()
+        (pstats.Stats(profiler, stream=stream)
+               .sort_stats('cumulative')
+               .print_stats(30))
+        return stream.getvalue()
+
+    def run(self, name, func, args, kwargs):
+        profiler = self._make_profiler(name)
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self._started_tracing = True
+            # the peak the enclosing stage reached so far is kept aside
+            # before the peak is reset, children report theirs to it
+            if self._peaks:
+                self._peaks[-1] = max(self._peaks[-1],
+                                      tracemalloc.get_traced_memory()[1])
+            self._peaks.append(0)
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        if profiler is not None:
+            profiler.enable()
+
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            if profiler is not None:
+                profiler.disable()
+                self.profiles[name] = self._profile_text(profiler)
+            peak = None
+            if self.trace_memory:
+                peak = max(tracemalloc.get_traced_memory()[1],
+                           self._peaks.pop())
+                if self._peaks:
+                    self._peaks[-1] = max(self._peaks[-1], peak)
+                elif self._started_tracing:
+                    tracemalloc.stop()
+                    self._started_tracing = False
+
+        self.stages.append({
+            'stage': name,
+            'seconds': seconds,
+            'rows_in': _rows(args[0]) if args else None,
+            'rows_out': _rows(result),
+            # memory allocated on top of what was in use before the stage
+            'peak_memory_mb': (None if peak is None
+                               else (peak - baseline) / 2 ** 20)
+        })
+        return result
+
+    def log(self, logger=None):
+        '''
+        logger: logger to write one json line per stage to
+        '''
+        logger = logger or logging.getLogger(__name__)
+        for record in self.stages:
+            logger.info(json.dumps(record, ensure_ascii=False))
+        for name, text in self.profiles.items():
+            logger.info(f"profile of {name}:\n{text}")
+
+    def to_frame(self):
+        return pd.DataFrame(self.stages)
+
+
+def run_stage(stage, func, /, *args, **kwargs):
+    '''
+    stage: stage name, ex: weather.read_csv
+    func: stage to run on args and kwargs, rows in are counted on the
+          first of args
+
+    Runs func as it is when no instrument() block is active.
+    '''
+    report = _REPORT.get()
+    if report is None:
+        return func(*args, **kwargs)
+    return report.run(stage, func, args, kwargs)
+
+
+@contextmanager
+def instrument(profile_stage=None, profiler='cprofile', trace_memory=True):
+    '''
+    profile_stage: name of the stage to profile, None profiles none
+    profiler: cprofile for deterministic profiles, sample for a
+              sampling profile with less overhead
+    trace_memory: trace the peak memory of every stage, slows them down
+
+    yields the StageReport the stages run inside the block are added to
+    '''
+    report = StageReport(profile_stage, profiler, trace_memory)
+    token = _REPORT.set(report)
+    try:
+        yield report
+    finally:
+        _REPORT.reset(token)
+
+
+class _Reported:
+    # result of a worker process call with the stages it ran
+    def __init__(self, result, stages, profiles):
+        self.result = result
+        self.stages = stages
+        self.profiles = profiles
+
+
+def _run_reported(options, func, *args):
+    with instrument(**options) as report:
+        result = func(*args)
+    return _Reported(result, report.stages, report.profiles)
+
+
+def submit(executor, func, *args):
+    '''
+    executor: process pool
+    func: function to run in a worker process
+
+    Stages run by the worker are added to the active report, see collect.
+    '''
+    report = _REPORT.get()
+    if report is None:
+        return executor.submit(func, *args)
+    return executor.submit(_run_reported, report.options, func, *args)
+
+
+def collect(future):
+    '''
+    future: future returned by submit
+
+    returns its result and adds the stages of the worker to the active
+    report
+    '''
+    value = future.result()
+    if isinstance(value, _Reported):
+        report = _REPORT.get()
+        if report is not None:
+            report.merge(value.stages, value.profiles)
+        return value.result
+    return value
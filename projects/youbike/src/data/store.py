@@ -0,0 +1,285 @@
+import os
+from itertools import repeat
+from pathlib import Path
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+
+
+YOUBIKE_STORE_PATH = 'data/processed/youbike-history'
+WEATHER_AIR_STORE_PATH = 'data/processed/weather-air-history'
+INTEGRATION_STORE_PATH = 'data/processed/youbike-integration'
+FEATURE_STORE_PATH = 'data/processed/youbike-features'
+CUBE_STORE_PATH = 'data/processed/youbike-cube'
+MATRIX_STORE_PATH = 'data/processed/youbike-matrix'
+
+
+def _month_strings(times):
+    # 'YYYY-MM' partition values, compared lexicographically when reading
+    return pd.DatetimeIndex(times).values.astype('datetime64[M]').astype(str)
+
+
+def _time_range_filters(time_column, start=None, end=None):
+    # month filters prune whole partitions, the time filters are checked
+    # against the row-group statistics inside the remaining files
+    filters = []
+    if start is not None:
+        start = pd.Timestamp(start)
+        filters += [('month', '>=', _month_strings([start])[0]),
+                    (time_column, '>=', start)]
+    if end is not None:
+        end = pd.Timestamp(end)
+        filters += [('month', '<=', _month_strings([end])[0]),
+                    (time_column, '<=', end)]
+    return filters
+
+
+def write_parquet_store(df, path, time_column, partition_cols=(),
+                        row_group_size=100000):
+    '''
+    df: dataframe, time_column may be a column or an index level
+    path: store root directory, new files are added next to existing ones
+    time_column: datetime column used for the month partitions
+    partition_cols: extra partition columns placed before month
+    row_group_size: max rows per row group
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    df = df.reset_index() if time_column not in df.columns else df
+    df = df.sort_values(time_column, kind='mergesort')
+    df = df.assign(month=_month_strings(df[time_column]))
+
+    pq.write_to_dataset(
+        pa.Table.from_pandas(df, preserve_index=False),
+        path,
+        partition_cols=list(partition_cols) + ['month'],
+        basename_template=f"part-{uuid4().hex}-{{i}}.parquet",
+        existing_data_behavior='overwrite_or_ignore',
+        row_group_size=row_group_size
+    )
+
+
+def read_parquet_store(path, time_column, columns=None, filters=None,
+                       start=None, end=None):
+    '''
+    path: store root directory
+    time_column: datetime column of the store
+    columns: columns to read besides time_column, None reads all
+    filters: extra pyarrow filters, ex: [('stop_no', 'in', [186])]
+    start: start datetime included
+    end: end datetime included
+    '''
+    import pyarrow.parquet as pq
+
+    if columns is not None:
+        columns = [time_column] + [c for c in columns if c != time_column]
+    filters = list(filters or []) + _time_range_filters(time_column,
+                                                        start, end)
+    table = pq.read_table(path, columns=columns, filters=filters or None)
+    df = table.to_pandas()
+    return df.drop(columns='month', errors='ignore')
+
+
+def list_partitions(path, months=None):
+    '''
+    path: store root directory
+    months: only the partitions of these 'YYYY-MM' months, None lists all
+
+    returns the month partition directories, the leaves of the store
+    '''
+    months = None if months is None else set(months)
+    return sorted(directory for directory in Path(path).rglob('month=*')
+                  if months is None
+                  or directory.name.split('=', 1)[1] in months)
+
+
+def list_stations(path):
+    '''
+    path: store root directory, partitioned by stop_no
+
+    returns the stations of the store from its partition directories, no
+    file is read
+    '''
+    return sorted(int(directory.name.split('=', 1)[1])
+                  for directory in Path(path).glob('stop_no=*'))
+
+
+def compact_partition(directory, time_column, combine=None,
+                      row_group_size=100000):
+    '''
+    directory: partition directory
+    time_column: datetime column the rows are sorted by
+    combine: function applied to the rows before they are written, ex: to
+             merge the rows of a key written by different appends
+    row_group_size: max rows per row group
+
+    Rewrites the files of the partition as one file. The new file is
+    moved in before the old ones are removed, a reader listing the
+    partition in between sees rows twice but never misses one. Returns
+    the number of files replaced.
+    '''
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    files = sorted(Path(directory).glob('*.parquet'))
+    if len(files) < 2:
+        return 0
+    table = ds.dataset([str(f) for f in files], format='parquet').to_table()
+    df = table.to_pandas()
+    if combine is not None:
+        df = combine(df)
+    df = df.sort_values(time_column, kind='mergesort')
+
+    name = f"part-{uuid4().hex}-0.parquet"
+    # files starting with a dot are skipped when a store is read
+    tmp_path = Path(directory) / f".{name}"
+    pq.write_table(pa.Table.from_pandas(df, preserve_index=False), tmp_path,
+                   row_group_size=row_group_size)
+    os.replace(tmp_path, Path(directory) / name)
+    for f in files:
+        f.unlink()
+    return len(files)
+
+
+def compact_parquet_store(path, time_column, combine=None, months=None,
+                          min_files=2, executor=None):
+    '''
+    path: store root directory
+    time_column: datetime column of the store
+    combine: see compact_partition
+    months: only compact the partitions of these 'YYYY-MM' months
+    min_files: partitions with fewer files are left as they are
+    executor: executor the partitions are compacted in, None compacts
+              them one after the other
+
+    Every append writes one more file per partition, compacting bounds
+    the number of files a read opens. Returns the files replaced.
+    '''
+    directories = [directory for directory in list_partitions(path, months)
+                   if len(list(directory.glob('*.parquet'))) >= min_files]
+    mapper = map if executor is None else executor.map
+    return sum(mapper(compact_partition, directories, repeat(time_column),
+                      repeat(combine)))
+
+
+def _fragment_time_bounds(fragment, time_column):
+    # from the row-group statistics, the column is only read if a file
+    # was written without them
+    metadata = fragment.metadata
+    position = metadata.schema.names.index(time_column)
+    bounds = []
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(position).statistics
+        if statistics is None or not statistics.has_min_max:
+            times = fragment.to_table(
+                columns=[time_column])[time_column].to_pandas()
+            return times.min(), times.max()
+        bounds.append((statistics.min, statistics.max))
+    if not bounds:
+        return pd.NaT, pd.NaT
+    return (pd.Timestamp(min(low for low, _ in bounds)),
+            pd.Timestamp(max(high for _, high in bounds)))
+
+
+def read_time_bounds(path, time_column='db_update_time'):
+    '''
+    path: store root directory
+    time_column: datetime column of the store
+
+    returns the first and the last time of the store, None for an empty
+    store; only the files of the first and the last month partitions are
+    opened and only their footers are read
+    '''
+    import pyarrow.dataset as ds
+
+    by_month = {}
+    for fragment in ds.dataset(path, format='parquet',
+                               partitioning='hive').get_fragments():
+        month = ds.get_partition_keys(fragment.partition_expression)['month']
+        by_month.setdefault(month, []).append(fragment)
+    if not by_month:
+        return None, None
+
+    def bounds(fragments, which):
+        times = [_fragment_time_bounds(fragment, time_column)[which]
+                 for fragment in fragments]
+        return [time for time in times if pd.notna(time)]
+
+    lows = bounds(by_month[min(by_month)], 0)
+    highs = bounds(by_month[max(by_month)], 1)
+    return (min(lows) if lows else None, max(highs) if highs else None)
+
+
+def write_youbike_store(df, path=YOUBIKE_STORE_PATH):
+    write_parquet_store(df, path, 'db_update_time',
+                        partition_cols=['stop_no'])
+
+
+def read_youbike_store(path=YOUBIKE_STORE_PATH, stop_no=None, columns=None,
+                       start=None, end=None):
+    '''
+    path: store root directory
+    stop_no: a station or a list of stations, None reads all of them
+    columns: columns to read, None reads all
+    start: start datetime included
+    end: end datetime included
+    '''
+    filters = []
+    if stop_no is not None:
+        stops = [stop_no] if np.isscalar(stop_no) else list(stop_no)
+        filters.append(('stop_no', 'in', stops))
+    if columns is not None and 'stop_no' not in columns:
+        columns = ['stop_no'] + list(columns)
+
+    df = read_parquet_store(path, 'db_update_time', columns=columns,
+                            filters=filters, start=start, end=end)
+    # partition values come back as categoricals
+    df['stop_no'] = df['stop_no'].astype('int32')
+
+    if stop_no is not None and np.isscalar(stop_no):
+        return (df.sort_values('db_update_time')
+                  .set_index('db_update_time'))
+    return (df.sort_values(['stop_no', 'db_update_time'])
+              .set_index(['stop_no', 'db_update_time']))
+
+
+def write_integration_store(df, path=INTEGRATION_STORE_PATH):
+    write_parquet_store(df, path, 'db_update_time',
+                        partition_cols=['stop_no'])
+
+
+def read_integration_store(path=INTEGRATION_STORE_PATH, stop_no=None,
+                           columns=None, start=None, end=None):
+    return read_youbike_store(path, stop_no=stop_no, columns=columns,
+                              start=start, end=end)
+
+
+def write_feature_store(df, path=FEATURE_STORE_PATH):
+    write_parquet_store(df, path, 'db_update_time',
+                        partition_cols=['stop_no'])
+
+
+def read_feature_store(path=FEATURE_STORE_PATH, stop_no=None, columns=None,
+                       start=None, end=None):
+    return read_youbike_store(path, stop_no=stop_no, columns=columns,
+                              start=start, end=end)
+
+
+def write_weather_air_store(df, path=WEATHER_AIR_STORE_PATH):
+    write_parquet_store(df, path, '日期')
+
+
+def read_weather_air_store(path=WEATHER_AIR_STORE_PATH, columns=None,
+                           start=None, end=None):
+    '''
+    path: store root directory
+    columns: columns to read, None reads all
+    start: start datetime included
+    end: end datetime included
+    '''
+    df = read_parquet_store(path, '日期', columns=columns,
+                            start=start, end=end)
+    return df.sort_values('日期').set_index('日期')
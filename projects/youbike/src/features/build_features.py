@@ -0,0 +1,239 @@
+import logging
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.data.store import (
+    INTEGRATION_STORE_PATH, FEATURE_STORE_PATH,
+    read_integration_store, read_time_bounds, write_feature_store
+)
+
+
+TARGET_COLUMN = '可借車數'
+
+LAGS = {
+    '5min': '5min',
+    '1h': '1h',
+    '1d': '1D',
+    '1w': '7D'
+}
+
+ROLLING_WINDOWS = {
+    '1h': '1h',
+    '1d': '1D'
+}
+
+WEATHER_COLUMNS = [
+    '細懸浮微粒(μg/m^3)',
+    '總碳氫化合物(ppm)',
+    '懸浮微粒(μg/m^3)',
+    '甲烷(ppm)',
+    '一氧化碳(ppm)',
+    '二氧化氮(ppb)',
+    '氮氧化物(ppb)',
+    '二氧化硫(ppb)',
+    '臭氧(ppb)',
+    '氣溫(℃)',
+    '相對溼度(%)',
+    '風速(m/s)',
+    '風向(360degree)',
+    '降水量(mm)'
+]
+
+WEATHER_DELTA = '1h'
+
+# a lagged value is only used if it is at most this much older
+LAG_TOLERANCE = '5min'
+
+# history needed before the first row that gets features
+HISTORY_WINDOW = (max(map(pd.Timedelta, LAGS.values()))
+                  + pd.Timedelta(LAG_TOLERANCE))
+
+
+def _to_long(df):
+    # a single station frame is indexed by time only
+    df = df.reset_index()
+    if 'stop_no' not in df.columns:
+        df['stop_no'] = 0
+    return df.sort_values(['stop_no', 'db_update_time'], kind='mergesort')
+
+
+def _seconds(times):
+    return np.asarray(times, dtype='datetime64[s]').astype('int64')
+
+
+class FeatureHistory:
+    '''
+    Recent integrated rows of every station, sorted by (stop_no, time),
+    that features of any (stop_no, time) are looked up from.
+
+    Every lookup is a binary search on one int64 key per row, so
+    features of a batch of queries cost O(queries * log(rows)).
+    '''
+
+    def __init__(self, df):
+        '''
+        df: integrated dataframe, see get_youbike_integration_df
+        '''
+        df = _to_long(df)
+        self.stations = np.unique(df['stop_no'].values.astype('int64'))
+        self.times = df['db_update_time'].values
+        self.weather_columns = [c for c in WEATHER_COLUMNS
+                                if c in df.columns]
+        self.keys = self._keys(df['stop_no'].values, self.times)
+
+        target = df[TARGET_COLUMN].values.astype('float64')
+        valid = ~np.isnan(target)
+        target = np.where(valid, target, 0)
+        self.target = df[TARGET_COLUMN].values.astype('float32')
+        self.weather = df[self.weather_columns].values.astype('float32')
+        # prefix sums for the rolling windows
+        self.count_sum = np.concatenate([[0], np.cumsum(valid)])
+        self.target_sum = np.concatenate([[0], np.cumsum(target)])
+        self.square_sum = np.concatenate([[0], np.cumsum(target ** 2)])
+
+    def _keys(self, stops, times):
+        # station rank in the high bits, epoch seconds in the low bits;
+        # unknown stations get a rank no history row has
+        stops = np.asarray(stops, dtype='int64')
+        ranks = np.searchsorted(self.stations, stops)
+        known = ranks < len(self.stations)
+        known[known] = self.stations[ranks[known]] == stops[known]
+        ranks = np.where(known, ranks, len(self.stations))
+        return (ranks << 33) + _seconds(times)
+
+    def _last_positions(self, stops, times, tolerance):
+        # position of the last row of the station at or before each time
+        keys = self._keys(stops, times)
+        positions = np.searchsorted(self.keys, keys, side='right') - 1
+        found = positions >= 0
+        found[found] = (self.keys[positions[found]] >> 33
+                        == keys[found] >> 33)
+        found[found] = (times[found] - self.times[positions[found]]
+                        <= pd.Timedelta(tolerance).to_timedelta64())
+        return positions, found
+
+    def _lagged(self, values, stops, times, lag, tolerance):
+        times = np.asarray(times) - pd.Timedelta(lag).to_timedelta64()
+        positions, found = self._last_positions(stops, times, tolerance)
+        lagged = values[positions.clip(min=0)].astype('float32')
+        lagged[~found] = np.nan
+        return lagged
+
+    def _window_stats(self, stops, times, window):
+        # mean and std over [t - window, t), the row at t itself excluded
+        times = np.asarray(times)
+        start = times - pd.Timedelta(window).to_timedelta64()
+        lo = np.searchsorted(self.keys, self._keys(stops, start), 'left')
+        hi = np.searchsorted(self.keys, self._keys(stops, times), 'left')
+        count = self.count_sum[hi] - self.count_sum[lo]
+        total = self.target_sum[hi] - self.target_sum[lo]
+        squares = self.square_sum[hi] - self.square_sum[lo]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+            var = np.where(count > 1,
+                           (squares - total * mean) / (count - 1), np.nan)
+        return mean, np.sqrt(np.maximum(var, 0))
+
+    def features(self, stops, times):
+        '''
+        stops: station of every query
+        times: datetime of every query
+
+        returns a frame indexed by (stop_no, db_update_time)
+        '''
+        stops = np.asarray(stops, dtype='int64')
+        times = pd.DatetimeIndex(times).values
+        features = {}
+
+        for name, lag in LAGS.items():
+            features[f"{TARGET_COLUMN}_lag_{name}"] = self._lagged(
+                self.target, stops, times, lag, LAG_TOLERANCE)
+
+        for name, window in ROLLING_WINDOWS.items():
+            mean, std = self._window_stats(stops, times, window)
+            features[f"{TARGET_COLUMN}_rolling_mean_{name}"] = mean
+            features[f"{TARGET_COLUMN}_rolling_std_{name}"] = std
+
+        features.update(_cyclic_encodings(pd.Series(times)))
+        features['是否為週末'] = (
+            pd.DatetimeIndex(times).weekday.values >= 5).astype('int8')
+
+        # latest weather/air reading of the station and the one an hour
+        # before it
+        current = self._lagged(self.weather, stops, times, 0, WEATHER_DELTA)
+        previous = self._lagged(self.weather, stops, times, WEATHER_DELTA,
+                                WEATHER_DELTA)
+        for i, column in enumerate(self.weather_columns):
+            features[column] = current[:, i]
+            features[f"{column}_delta_{WEATHER_DELTA}"] = (
+                current[:, i] - previous[:, i])
+
+        index = pd.MultiIndex.from_arrays(
+            [stops, times], names=['stop_no', 'db_update_time'])
+        return pd.DataFrame(features, index=index).astype('float32')
+
+
+def _cyclic_encodings(times):
+    minutes = (times.dt.hour * 60 + times.dt.minute).values
+    weekdays = times.dt.weekday.values
+    return {
+        'time_of_day_sin': np.sin(2 * np.pi * minutes / 1440),
+        'time_of_day_cos': np.cos(2 * np.pi * minutes / 1440),
+        'weekday_sin': np.sin(2 * np.pi * weekdays / 7),
+        'weekday_cos': np.cos(2 * np.pi * weekdays / 7)
+    }
+
+
+def build_features(df, since=None):
+    '''
+    df: integrated dataframe, see get_youbike_integration_df
+    since: only return features of rows after this datetime, df should
+           still hold HISTORY_WINDOW of rows before it
+
+    returns a frame indexed by (stop_no, db_update_time)
+    '''
+    history = FeatureHistory(df)
+    rows = np.ones(len(history.times), dtype=bool)
+    if since is not None:
+        rows = history.times > pd.Timestamp(since).to_datetime64()
+
+    stops = history.stations[history.keys[rows] >> 33]
+    features_df = history.features(stops, history.times[rows])
+    features_df.insert(0, TARGET_COLUMN, history.target[rows])
+    return features_df
+
+
+def _last_feature_time(path):
+    if not Path(path).exists():
+        return None
+    return read_time_bounds(path)[1]
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True),
+                default=INTEGRATION_STORE_PATH)
+@click.argument('output_filepath', type=click.Path(),
+                default=FEATURE_STORE_PATH)
+def main(input_filepath, output_filepath):
+    """ Builds features for the integrated rows (../processed) that are
+        newer than the feature store and appends them to it.
+    """
+    logger = logging.getLogger(__name__)
+
+    since = _last_feature_time(output_filepath)
+    start = None if since is None else since - HISTORY_WINDOW
+    df = read_integration_store(input_filepath, start=start)
+    features_df = build_features(df, since=since)
+
+    if len(features_df):
+        write_feature_store(features_df, output_filepath)
+    logger.info(f"wrote features of {len(features_df)} rows")
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
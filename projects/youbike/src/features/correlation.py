@@ -0,0 +1,252 @@
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
+
+from src.data.rollup import RollupCache
+
+
+# sums every correlation is computed from, each one is a matrix of
+# x columns x y columns over the rows where both are observed
+_SUMS = ['n', 'sx', 'sy', 'sxx', 'syy', 'sxy']
+
+
+def _block_sums(x, y, symmetric=False):
+    # pairwise-complete sums of x (rows x p) against y (rows x q), done by
+    # BLAS matrix products; symmetric when y is x
+    x_observed, y_observed = ~np.isnan(x), ~np.isnan(y)
+    if x_observed.all() and y_observed.all():
+        # every pair has the same rows, one product is enough
+        ones = np.ones((x.shape[1], y.shape[1]))
+        return {
+            'n': ones * len(x),
+            'sx': ones * x.sum(axis=0)[:, None],
+            'sy': ones * y.sum(axis=0)[None, :],
+            'sxx': ones * (x ** 2).sum(axis=0)[:, None],
+            'syy': ones * (y ** 2).sum(axis=0)[None, :],
+            'sxy': x.T @ y
+        }
+
+    x0, y0 = np.where(x_observed, x, 0), np.where(y_observed, y, 0)
+    x_observed = x_observed.astype('float64')
+    y_observed = y_observed.astype('float64')
+    sums = {
+        'n': x_observed.T @ y_observed,
+        'sx': x0.T @ y_observed,
+        'sxx': (x0 ** 2).T @ y_observed,
+        'sxy': x0.T @ y0
+    }
+    if symmetric:
+        # copies, the sums are added to in place
+        sums['sy'], sums['syy'] = sums['sx'].T.copy(), sums['sxx'].T.copy()
+    else:
+        sums['sy'] = x_observed.T @ y0
+        sums['syy'] = x_observed.T @ y0 ** 2
+    return sums
+
+
+def _column_means(values):
+    # 0 for columns without any observation
+    observed = ~np.isnan(values)
+    count = observed.sum(axis=0)
+    return np.divide(np.where(observed, values, 0).sum(axis=0), count,
+                     out=np.zeros(values.shape[1]), where=count > 0)
+
+
+def _values(df, columns):
+    # columns as a float64 array, without a pandas take if df only has them
+    if list(df.columns) == columns:
+        return df.to_numpy(dtype='float64')
+    return df[columns].to_numpy(dtype='float64')
+
+
+def _correlation(sums, min_periods):
+    n = sums['n']
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cov = sums['sxy'] - sums['sx'] * sums['sy'] / n
+        x_var = sums['sxx'] - sums['sx'] ** 2 / n
+        y_var = sums['syy'] - sums['sy'] ** 2 / n
+        r = cov / np.sqrt(x_var * y_var)
+    r[(n < max(min_periods, 2)) | (x_var <= 0) | (y_var <= 0)] = np.nan
+    return r.clip(-1, 1)
+
+
+class CorrelationEngine:
+    '''
+    Pearson correlations of x columns against y columns at several lags,
+    updated with the rows appended to a series.
+
+    Only sums are kept, so memory does not grow with the rows and the
+    rows of an update are processed chunk_size at a time.
+    '''
+
+    def __init__(self, x_columns, y_columns=None, lags=(0,),
+                 chunk_size=100000, min_periods=2):
+        '''
+        x_columns: columns correlated
+        y_columns: columns they are correlated with, defaults to x_columns
+        lags: rows y lags behind x, non-negative; swap x and y for leads
+        chunk_size: rows multiplied at a time, bounds the memory
+        min_periods: pairs of observations needed for a correlation
+        '''
+        if min(lags) < 0:
+            raise ValueError('Lags must be non-negative')
+        self.x_columns = list(x_columns)
+        self.y_columns = list(x_columns if y_columns is None else y_columns)
+        self.lags = list(lags)
+        self.chunk_size = chunk_size
+        self.min_periods = min_periods
+        self.rows = 0
+        self._sums = {lag: None for lag in self.lags}
+        # correlations do not change when a column is shifted, shifting
+        # by a typical value keeps the sums of squares small
+        self._x_shift = None
+        self._y_shift = None
+        self._x_tail = np.empty((0, len(self.x_columns)))
+        self._y_tail = np.empty((0, len(self.y_columns)))
+
+    def update(self, df):
+        '''
+        df: rows on the same regular time grid as, and following, the
+            rows of the previous updates
+        '''
+        symmetric = self.x_columns == self.y_columns
+        x = _values(df, self.x_columns)
+        if self._x_shift is None:
+            # the means of the first rows are typical enough
+            self._x_shift = _column_means(x[:self.chunk_size])
+        x = x - self._x_shift
+        if symmetric:
+            y, self._y_shift = x, self._x_shift
+        else:
+            y = _values(df, self.y_columns)
+            if self._y_shift is None:
+                self._y_shift = _column_means(y[:self.chunk_size])
+            y = y - self._y_shift
+
+        # the last rows of the previous update are kept for the lags
+        start = len(self._x_tail)
+        if start:
+            x = np.vstack([self._x_tail, x])
+            y = x if symmetric else np.vstack([self._y_tail, y])
+
+        for lag in self.lags:
+            # x rows from start, paired with the y rows lag rows earlier
+            for lo in range(max(start, lag), len(x), self.chunk_size):
+                hi = min(lo + self.chunk_size, len(x))
+                sums = _block_sums(x[lo:hi], y[lo - lag:hi - lag],
+                                   symmetric=symmetric and lag == 0)
+                if self._sums[lag] is None:
+                    self._sums[lag] = sums
+                else:
+                    for name in _SUMS:
+                        self._sums[lag][name] += sums[name]
+
+        keep = max(self.lags)
+        # fewer rows than the largest lag are all kept
+        self._x_tail = x[max(len(x) - keep, 0):].copy() if keep else x[:0]
+        self._y_tail = y[max(len(y) - keep, 0):].copy() if keep else y[:0]
+        self.rows += len(df)
+        return self
+
+    def correlation(self, lag=0):
+        '''
+        returns the correlations of x(t) and y(t - lag), x columns x y
+        columns
+        '''
+        sums = self._sums[lag]
+        if sums is None:
+            r = np.full((len(self.x_columns), len(self.y_columns)), np.nan)
+        else:
+            r = _correlation(sums, self.min_periods)
+        return pd.DataFrame(r, index=self.x_columns, columns=self.y_columns)
+
+    def cross_correlation(self):
+        '''
+        returns one column of correlations per lag, indexed by (x, y)
+        '''
+        return pd.DataFrame({
+            lag: self.correlation(lag).stack(dropna=False)
+            for lag in self.lags
+        }).rename_axis(index=['x', 'y'], columns='lag')
+
+
+def correlation_matrix(df, method='pearson', lag=0, columns=None,
+                       chunk_size=100000, min_periods=2):
+    '''
+    df: dataframe indexed by time on a regular grid for lags other than 0
+    method: pearson or spearman
+    lag: rows the columns lag behind the rows of the matrix
+    columns: columns to correlate, defaults to the numeric ones
+    chunk_size: rows multiplied at a time
+    min_periods: pairs of observations needed for a correlation
+
+    Spearman correlations are the Pearson correlations of the ranks of
+    every column; with missing values the ranks are not recomputed for
+    every pair of columns as in DataFrame.corr.
+    '''
+    if columns is None:
+        # as select_dtypes(include=['number']), without copying the frame
+        columns = [column for column, dtype in df.dtypes.items()
+                   if is_numeric_dtype(dtype) and not is_bool_dtype(dtype)]
+    columns = list(columns)
+    if list(df.columns) != columns:
+        df = df[columns]
+    if method == 'spearman':
+        df = df.rank()
+    elif method != 'pearson':
+        raise ValueError(f"Unrecognized method: {method}")
+    engine = CorrelationEngine(columns, lags=[lag], chunk_size=chunk_size,
+                               min_periods=min_periods)
+    return engine.update(df).correlation(lag)
+
+
+def top_k_columns(corr, k, target=None):
+    '''
+    corr: square correlation matrix
+    k: columns kept
+    target: keep target and the k - 1 columns most correlated with it,
+            defaults to the columns with the strongest correlations with
+            any other column
+
+    returns the k x k sub-matrix
+    '''
+    strength = corr.abs()
+    if target is not None:
+        scores = strength[target].drop(target)
+        columns = [target] + list(scores.nlargest(k - 1).index)
+    else:
+        scores = strength.where(~np.eye(len(corr), dtype=bool)).max(axis=1)
+        columns = list(scores.nlargest(k).index)
+    return corr.loc[columns, columns]
+
+
+class CorrelationCache(RollupCache):
+    '''
+    LRU cache of correlation matrices keyed by frame, data version, row
+    range, method and lag, see RollupCache.
+    '''
+
+    def get(self, df, method='pearson', lag=0, version=None, start=None,
+            end=None, select=None):
+        '''
+        df: dataframe, see correlation_matrix
+        method: pearson or spearman
+        lag: rows the columns lag behind the rows of the matrix
+        version: token of the data, defaults to a hash of df
+        start: start of the rows of df correlated, passed to select
+        end: end of the rows of df correlated, passed to select
+        select: function(df, start, end) returning the rows of df to
+                correlate, needed with start or end
+
+        Entries are keyed on df itself, not on the selected rows, so
+        repeated calls for the same range hit the cache.
+        '''
+        def compute():
+            rows = df if start is None and end is None else select(
+                df, start, end)
+            return correlation_matrix(rows, method, lag)
+
+        return self._get(df, version, (method, lag, start, end), compute)
+
+
+CORRELATION_CACHE = CorrelationCache()
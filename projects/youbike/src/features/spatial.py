@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+from src.data.store import YOUBIKE_STORE_PATH, read_youbike_store
+
+
+# mean earth radius, haversine distances are returned in meters
+EARTH_RADIUS = 6371008.8
+
+REGISTRY_COLUMNS = ['lat', 'lng', 'stop_area', 'total_number']
+
+
+def get_station_registry(df):
+    '''
+    df: youbike dataframe with stop_no (column or index level) and the
+        REGISTRY_COLUMNS it has
+
+    returns one row per station indexed by stop_no, from its last row
+    '''
+    df = df.reset_index()
+    columns = [c for c in REGISTRY_COLUMNS if c in df.columns]
+    return (df.drop_duplicates('stop_no', keep='last')
+              .set_index('stop_no')[columns]
+              .sort_index())
+
+
+def read_station_registry(path=YOUBIKE_STORE_PATH, start=None):
+    '''
+    path: youbike store
+    start: only read rows from this datetime, the registry of a recent
+           month is enough and much cheaper to read
+    '''
+    df = read_youbike_store(path, columns=REGISTRY_COLUMNS, start=start)
+    return get_station_registry(df)
+
+
+def _radians(lat, lng):
+    return np.radians(np.column_stack([np.ravel(lat), np.ravel(lng)]))
+
+
+class StationIndex:
+    '''
+    Ball tree over the station coordinates with the haversine metric,
+    every query takes arrays of points and is answered in one call.
+    '''
+
+    def __init__(self, registry):
+        '''
+        registry: stations indexed by stop_no, see get_station_registry
+        '''
+        # imported here, importing this module does not load sklearn
+        from sklearn.neighbors import BallTree
+
+        self.registry = registry
+        self.stations = registry.index.values
+        self.tree = BallTree(_radians(registry['lat'], registry['lng']),
+                             metric='haversine')
+
+    def nearest(self, lat, lng, k=5):
+        '''
+        lat: latitudes of the query points, in degrees
+        lng: longitudes of the query points, in degrees
+        k: stations per point
+
+        returns stop_no and distances in meters, points x k, nearest first
+        '''
+        distances, positions = self.tree.query(_radians(lat, lng),
+                                               k=min(k, len(self.stations)))
+        return self.stations[positions], distances * EARTH_RADIUS
+
+    def within(self, lat, lng, radius):
+        '''
+        lat: latitudes of the query points, in degrees
+        lng: longitudes of the query points, in degrees
+        radius: meters
+
+        returns one array of stop_no and one of distances per point,
+        nearest first
+        '''
+        positions, distances = self.tree.query_radius(
+            _radians(lat, lng), r=radius / EARTH_RADIUS,
+            return_distance=True, sort_results=True)
+        return ([self.stations[p] for p in positions],
+                [d * EARTH_RADIUS for d in distances])
+
+    def neighbour_weights(self, k=None, radius=None, include_self=False):
+        '''
+        k: number of nearest other stations
+        radius: meters, used if k is None
+        include_self: count every station as its own neighbour
+
+        returns a sparse stations x stations matrix, row i has a 1 for
+        every neighbour of station i, in the order of self.stations
+        '''
+        from scipy.sparse import csr_matrix
+
+        points = _radians(self.registry['lat'], self.registry['lng'])
+        n = len(self.stations)
+        if k is not None:
+            _, positions = self.tree.query(points, k=min(k + 1, n))
+            # k + 1 points are asked for, the station itself is dropped,
+            # or the farthest one if a duplicate location came first
+            drop = positions == np.arange(n)[:, None]
+            drop[~drop.any(axis=1), -1] = True
+            rows = np.repeat(np.arange(n), positions.shape[1] - 1)
+            columns = positions[~drop]
+        elif radius is not None:
+            positions = self.tree.query_radius(points, r=radius / EARTH_RADIUS)
+            rows = np.repeat(np.arange(n), [len(p) for p in positions])
+            columns = np.concatenate(positions)
+            rows, columns = rows[rows != columns], columns[rows != columns]
+        else:
+            raise ValueError('Either k or radius is needed')
+
+        if include_self:
+            rows = np.concatenate([rows, np.arange(n)])
+            columns = np.concatenate([columns, np.arange(n)])
+        return csr_matrix((np.ones(len(rows)), (rows, columns)),
+                          shape=(n, n))
+
+    def neighbourhood_availability(self, wide, k=None, radius=None,
+                                   include_self=False):
+        '''
+        wide: availability indexed by time with one column per station,
+              ex: AvailabilityMatrix.to_frame, NaN for missing readings
+        k: number of nearest other stations
+        radius: meters, used if k is None
+        include_self: add the station itself to its neighbourhood
+
+        returns the sum and the mean of the neighbours of every station,
+        frames shaped like wide, the mean is over the neighbours observed;
+        neighbours that are not columns of wide are left out
+        '''
+        positions = pd.Index(self.stations).get_indexer(wide.columns)
+        if (positions < 0).any():
+            raise KeyError(f"Unknown stations: "
+                           f"{list(wide.columns[positions < 0])}")
+        weights = self.neighbour_weights(k, radius, include_self)
+        weights = weights[positions][:, positions]
+
+        values = wide.values.astype('float64')
+        observed = ~np.isnan(values)
+        total = (weights @ np.where(observed, values, 0).T).T
+        count = (weights @ observed.T.astype('float64')).T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = np.where(count > 0, total / count, np.nan)
+        return (pd.DataFrame(total, index=wide.index, columns=wide.columns),
+                pd.DataFrame(mean, index=wide.index, columns=wide.columns))
+
+
+def area_availability(wide, registry, column='stop_area', how='sum'):
+    '''
+    wide: availability indexed by time with one column per station
+    registry: stations indexed by stop_no, see get_station_registry
+    column: registry column the stations are grouped by
+    how: sum or mean
+
+    returns the availability of every area indexed by time
+    '''
+    areas = registry[column].reindex(wide.columns)
+    grouped = wide.T.groupby(areas.values, observed=True)
+    if how == 'sum':
+        return grouped.sum(min_count=1).T
+    return grouped.agg(how).T
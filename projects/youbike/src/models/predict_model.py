@@ -0,0 +1,220 @@
+import asyncio
+import json
+import logging
+import pickle
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+
+from src.data.store import (
+    INTEGRATION_STORE_PATH, read_integration_store, read_time_bounds
+)
+from src.features.build_features import (
+    HISTORY_WINDOW, TARGET_COLUMN, FeatureHistory
+)
+from src.models.train_model import MODEL_PATH
+
+
+def load_model(model_path=MODEL_PATH):
+    '''
+    model_path: pickled model, its feature schema is read from the json
+                file next to it
+    '''
+    model_path = Path(model_path)
+    with open(model_path, 'rb') as f:
+        model = pickle.load(f)
+    with open(model_path.with_suffix('.json')) as f:
+        schema = json.load(f)
+    return model, schema
+
+
+def load_recent_history(path=INTEGRATION_STORE_PATH, until=None,
+                        window=HISTORY_WINDOW):
+    '''
+    path: integration store root directory
+    until: end of the window, defaults to the latest row of the store
+    window: length of history kept for the features
+    '''
+    if until is None:
+        _, until = read_time_bounds(path)
+    return read_integration_store(path, start=pd.Timestamp(until) - window,
+                                  end=until)
+
+
+class Predictor:
+    '''
+    Keeps a trained model and a window of recent history in memory and
+    forecasts availability for batches of (stop_no, time) queries.
+    '''
+
+    def __init__(self, model_path=MODEL_PATH, history_df=None):
+        '''
+        model_path: pickled model, see train_model.train
+        history_df: recent integrated rows, see load_recent_history
+        '''
+        self.model, self.schema = load_model(model_path)
+        self.feature_columns = self.schema['features']
+        self.history_df = None
+        self.history = None
+        if history_df is not None:
+            self.update_history(history_df)
+
+    def update_history(self, df):
+        '''
+        df: new integrated rows, rows older than HISTORY_WINDOW before the
+            latest row are dropped
+        '''
+        df = df if df.index.nlevels > 1 else (
+            df.assign(stop_no=0).set_index('stop_no', append=True)
+              .swaplevel())
+        if self.history_df is not None:
+            df = pd.concat([self.history_df, df])
+            df = df[~df.index.duplicated(keep='last')]
+        times = df.index.get_level_values('db_update_time')
+        self.history_df = df[times >= times.max() - HISTORY_WINDOW]
+        self.history = FeatureHistory(self.history_df)
+
+    @property
+    def stations(self):
+        return self.history.stations
+
+    def predict(self, stops, times):
+        '''
+        stops: station of every query
+        times: datetime of every query
+
+        returns forecasts indexed by (stop_no, db_update_time)
+        '''
+        features = self.history.features(stops, times)[self.feature_columns]
+        return pd.Series(self.model.predict(features.values),
+                         index=features.index, name=TARGET_COLUMN)
+
+    def predict_all(self, time):
+        '''
+        time: datetime to forecast every known station at
+        '''
+        times = np.full(len(self.stations), pd.Timestamp(time).to_datetime64())
+        return self.predict(self.stations, times)
+
+
+class MicroBatcher:
+    '''
+    Collects concurrent requests for up to max_delay seconds or
+    max_batch_size queries and answers them with one predict call.
+    '''
+
+    def __init__(self, predictor, max_batch_size=4096, max_delay=0.002):
+        self.predictor = predictor
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.queue = asyncio.Queue()
+
+    async def predict(self, stops, times):
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((np.asarray(stops, dtype='int64'),
+                              pd.DatetimeIndex(times).values, future))
+        return await future
+
+    async def _next_batch(self):
+        batch = [await self.queue.get()]
+        size = len(batch[0][0])
+        deadline = asyncio.get_running_loop().time() + self.max_delay
+        while size < self.max_batch_size:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                request = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(request)
+            size += len(request[0])
+        return batch
+
+    async def run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                predictions = self.predictor.predict(
+                    np.concatenate([stops for stops, _, _ in batch]),
+                    np.concatenate([times for _, times, _ in batch])
+                ).values
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            # requests cancelled while waiting are skipped, setting their
+            # future would raise and stop the worker for every request
+            offset = 0
+            for stops, _, future in batch:
+                if not future.done():
+                    future.set_result(predictions[offset:offset + len(stops)])
+                offset += len(stops)
+
+
+async def _handle_client(batcher, reader, writer):
+    # one json request per line: {"stop_no": [...], "time": [...]}
+    while True:
+        line = await reader.readline()
+        if not line:
+            break
+        try:
+            request = json.loads(line)
+            predictions = await batcher.predict(request['stop_no'],
+                                                request['time'])
+            response = {'prediction': predictions.tolist()}
+        except Exception as e:
+            response = {'error': str(e)}
+        writer.write(json.dumps(response).encode() + b'\n')
+        await writer.drain()
+    writer.close()
+
+
+async def serve(predictor, host='127.0.0.1', port=8765, **batcher_kwargs):
+    '''
+    predictor: Predictor to answer the requests with
+    host: address to listen on
+    port: port to listen on
+    batcher_kwargs: max_batch_size and max_delay of the MicroBatcher
+    '''
+    batcher = MicroBatcher(predictor, **batcher_kwargs)
+    worker = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(
+        lambda reader, writer: _handle_client(batcher, reader, writer),
+        host, port)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        worker.cancel()
+
+
+@click.command()
+@click.argument('model_filepath', type=click.Path(exists=True),
+                default=MODEL_PATH)
+@click.argument('history_filepath', type=click.Path(exists=True),
+                default=INTEGRATION_STORE_PATH)
+@click.option('--host', default='127.0.0.1', show_default=True)
+@click.option('--port', type=int, default=8765, show_default=True)
+@click.option('--max-delay', type=float, default=0.002, show_default=True,
+              help='Seconds a request may wait for a batch to fill.')
+def main(model_filepath, history_filepath, host, port, max_delay):
+    """ Serves availability forecasts of a trained model (../models) over
+        a json lines socket, with history from (../processed).
+    """
+    logger = logging.getLogger(__name__)
+    predictor = Predictor(model_filepath,
+                          load_recent_history(history_filepath))
+    logger.info(f"serving {len(predictor.stations)} stations "
+                f"on {host}:{port}")
+    asyncio.run(serve(predictor, host, port, max_delay=max_delay))
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
@@ -0,0 +1,235 @@
+import json
+import logging
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import click
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+
+from src.data.store import FEATURE_STORE_PATH, read_time_bounds
+from src.features.build_features import TARGET_COLUMN
+
+
+MODEL_PATH = 'models/youbike-availability.pkl'
+
+# columns of the feature store that are keys, not features
+KEY_COLUMNS = ['stop_no', 'db_update_time', 'month']
+
+
+def _feature_dataset(path):
+    return ds.dataset(path, format='parquet', partitioning='hive')
+
+
+def get_feature_columns(path=FEATURE_STORE_PATH):
+    names = _feature_dataset(path).schema.names
+    return [name for name in names
+            if name not in KEY_COLUMNS and name != TARGET_COLUMN]
+
+
+def iter_batches(path, feature_columns, start=None, end=None,
+                 batch_size=65536, shuffle=None):
+    '''
+    path: feature store root directory
+    feature_columns: columns used as model input
+    start: start datetime included
+    end: end datetime excluded
+    batch_size: rows per batch, bounds the memory used by training
+    shuffle: numpy random generator, shuffles the order of the files and
+             the rows of every batch; None reads in store order
+
+    yields (X, y) float32 arrays read batch by batch from the store
+    '''
+    time = ds.field('db_update_time')
+    condition = ds.field(TARGET_COLUMN).is_valid()
+    if start is not None:
+        condition &= time >= pd.Timestamp(start)
+    if end is not None:
+        condition &= time < pd.Timestamp(end)
+
+    # files are laid out one station and month at a time, read in path
+    # order an epoch would see the stations one after the other
+    fragments = list(_feature_dataset(path).get_fragments(filter=condition))
+    if shuffle is not None:
+        fragments = [fragments[i]
+                     for i in shuffle.permutation(len(fragments))]
+
+    for fragment in fragments:
+        for batch in fragment.to_batches(
+                columns=feature_columns + [TARGET_COLUMN],
+                filter=condition, batch_size=batch_size):
+            if not batch.num_rows:
+                continue
+            df = batch.to_pandas()
+            X = df[feature_columns].to_numpy(dtype='float32')
+            y = df[TARGET_COLUMN].to_numpy(dtype='float32')
+            if shuffle is not None:
+                rows = shuffle.permutation(len(y))
+                X, y = X[rows], y[rows]
+            yield X, y
+
+
+def get_time_bounds(path=FEATURE_STORE_PATH):
+    # partition values and row-group statistics, no column is loaded
+    return read_time_bounds(path)
+
+
+def make_model():
+    # imported here, modules that only need MODEL_PATH from this one do
+    # not load sklearn before they unpickle a model
+    from sklearn.linear_model import SGDRegressor
+    from sklearn.pipeline import Pipeline
+    from sklearn.preprocessing import FunctionTransformer, StandardScaler
+
+    # nan_to_num after scaling imputes missing lags with their mean
+    return Pipeline([
+        ('scaler', StandardScaler()),
+        ('impute', FunctionTransformer(np.nan_to_num)),
+        ('regressor', SGDRegressor(random_state=0))
+    ])
+
+
+def fit_model(path, feature_columns, start=None, end=None, epochs=3,
+              batch_size=65536, seed=0):
+    '''
+    path: feature store root directory
+    feature_columns: columns used as model input
+    start: start datetime included
+    end: end datetime excluded
+    epochs: passes over the training rows
+    batch_size: rows per batch
+    seed: seed of the order the rows are seen in every epoch
+
+    Streams the training rows from the store, one pass for the scaler
+    and then one shuffled pass per epoch for the regressor.
+    '''
+    model = make_model()
+    scaler = model.named_steps['scaler']
+    regressor = model.named_steps['regressor']
+
+    rng = np.random.default_rng(seed)
+
+    def batches(shuffle=None):
+        return iter_batches(path, feature_columns, start=start, end=end,
+                            batch_size=batch_size, shuffle=shuffle)
+
+    for X, _ in batches():
+        scaler.partial_fit(X)
+    for _ in range(epochs):
+        for X, y in batches(shuffle=rng):
+            regressor.partial_fit(model[:-1].transform(X), y)
+    return model
+
+
+def evaluate_model(model, path, feature_columns, start=None, end=None,
+                   batch_size=65536):
+    n = abs_error = squared_error = 0.0
+    for X, y in iter_batches(path, feature_columns, start=start, end=end,
+                             batch_size=batch_size):
+        error = model.predict(X) - y
+        n += len(y)
+        abs_error += np.abs(error).sum()
+        squared_error += np.square(error).sum()
+    if not n:
+        return {'rows': 0, 'mae': None, 'rmse': None}
+    return {'rows': int(n), 'mae': abs_error / n,
+            'rmse': np.sqrt(squared_error / n)}
+
+
+def _run_fold(path, feature_columns, train_end, valid_end, epochs,
+              batch_size):
+    model = fit_model(path, feature_columns, end=train_end, epochs=epochs,
+                      batch_size=batch_size)
+    metrics = evaluate_model(model, path, feature_columns, start=train_end,
+                             end=valid_end, batch_size=batch_size)
+    return dict(metrics, train_end=str(train_end), valid_end=str(valid_end))
+
+
+def get_time_series_folds(start, end, n_splits=3):
+    '''
+    start: first datetime of the data
+    end: last datetime of the data
+    n_splits: number of folds
+
+    Every fold trains on all rows before its cutoff and is validated on
+    the block of rows right after it.
+    '''
+    edges = pd.date_range(start, end, periods=n_splits + 2)
+    edges = edges[:-1].append(pd.DatetimeIndex([end + pd.Timedelta(1)]))
+    return list(zip(edges[1:-1], edges[2:]))
+
+
+def train(path=FEATURE_STORE_PATH, model_path=MODEL_PATH, n_splits=3,
+          workers=None, epochs=3, batch_size=65536):
+    '''
+    path: feature store root directory
+    model_path: where the fitted model is pickled, its feature schema is
+                saved next to it as json
+    n_splits: time series cross validation folds, 0 skips validation
+    workers: worker processes, defaults to the number of cpus
+    epochs: passes over the training rows
+    batch_size: rows per batch
+
+    Cross validation folds and the final fit run in parallel processes.
+    '''
+    logger = logging.getLogger(__name__)
+    feature_columns = get_feature_columns(path)
+    start, end = get_time_bounds(path)
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        folds = [
+            executor.submit(_run_fold, path, feature_columns, train_end,
+                            valid_end, epochs, batch_size)
+            for train_end, valid_end in get_time_series_folds(
+                start, end, n_splits)
+        ] if n_splits else []
+        final = executor.submit(fit_model, path, feature_columns,
+                                epochs=epochs, batch_size=batch_size)
+        cv_metrics = [fold.result() for fold in folds]
+        model = final.result()
+
+    for metrics in cv_metrics:
+        logger.info(f"fold until {metrics['valid_end']}: "
+                    f"mae {metrics['mae']}, rmse {metrics['rmse']}")
+
+    model_path = Path(model_path)
+    model_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(model_path, 'wb') as f:
+        pickle.dump(model, f)
+    with open(model_path.with_suffix('.json'), 'w') as f:
+        json.dump({
+            'target': TARGET_COLUMN,
+            'features': feature_columns,
+            'train_start': str(start),
+            'train_end': str(end),
+            'cv': cv_metrics
+        }, f, ensure_ascii=False, indent=2, default=float)
+    return model
+
+
+@click.command()
+@click.argument('input_filepath', type=click.Path(exists=True),
+                default=FEATURE_STORE_PATH)
+@click.argument('output_filepath', type=click.Path(), default=MODEL_PATH)
+@click.option('--n-splits', type=int, default=3, show_default=True)
+@click.option('--workers', type=int, default=None,
+              help='Worker processes, defaults to the number of cpus.')
+@click.option('--epochs', type=int, default=3, show_default=True)
+@click.option('--batch-size', type=int, default=65536, show_default=True)
+def main(input_filepath, output_filepath, n_splits, workers, epochs,
+         batch_size):
+    """ Trains the availability model on the feature store (../processed)
+        and saves it with its feature schema (saved in ../models).
+    """
+    logger = logging.getLogger(__name__)
+    logger.info('training model from feature store')
+    train(input_filepath, output_filepath, n_splits=n_splits,
+          workers=workers, epochs=epochs, batch_size=batch_size)
+
+
+if __name__ == '__main__':
+    log_fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    logging.basicConfig(level=logging.INFO, format=log_fmt)
+    main()
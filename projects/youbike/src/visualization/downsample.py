@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+
+# about two points per horizontal pixel of a 12 inch wide, 100 dpi figure
+DEFAULT_MAX_POINTS = 2400
+
+
+def _as_float(values):
+    values = np.asarray(values)
+    if np.issubdtype(values.dtype, np.datetime64):
+        return values.astype('datetime64[ns]').astype('int64').astype(float)
+    return values.astype(float)
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    x: increasing x values, numbers or datetimes
+    y: y values
+    n_out: number of points to keep
+
+    returns the positions kept by largest-triangle-three-buckets
+    '''
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = _as_float(x)
+    y = _as_float(y)
+
+    # first and last points are kept, the rest is split into n_out - 2
+    # buckets; each bucket is wider than one point so none is empty
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        next_hi = edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[hi:next_hi].mean()
+        next_y = y[hi:next_hi].mean()
+        areas = np.abs((x[a] - next_x) * (y[lo:hi] - y[a])
+                       - (x[a] - x[lo:hi]) * (next_y - y[a]))
+        a = lo + areas.argmax()
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(y, n_out):
+    '''
+    y: y values
+    n_out: number of points to keep, about
+
+    returns the positions of the minimum and maximum of n_out / 2 buckets
+    '''
+    n = len(y)
+    buckets = n_out // 2
+    if n <= n_out or buckets < 1:
+        return np.arange(n)
+    y = _as_float(y)
+
+    # bucket sizes differ by at most one, pad them into one 2d block
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    width = np.diff(edges).max()
+    positions = edges[:-1, None] + np.arange(width)
+    inside = positions < edges[1:, None]
+    block = np.where(inside, y[positions.clip(max=n - 1)], np.nan)
+
+    lows = edges[:-1] + np.nanargmin(block, axis=1)
+    highs = edges[:-1] + np.nanargmax(block, axis=1)
+    return np.unique(np.concatenate([[0, n - 1], lows, highs]))
+
+
+def downsample_indices(x, y, max_points=DEFAULT_MAX_POINTS, method='lttb'):
+    '''
+    x: x values
+    y: y values, missing values are never kept
+    max_points: number of points to keep, None keeps all of them
+    method: lttb or minmax
+    '''
+    valid = pd.notna(np.asarray(y))
+    if not valid.all():
+        positions = np.flatnonzero(valid)
+        return positions[downsample_indices(
+            np.asarray(x)[valid], np.asarray(y)[valid], max_points, method)]
+    if max_points is None:
+        return np.arange(len(y))
+    if method == 'lttb':
+        return lttb_indices(x, y, max_points)
+    if method == 'minmax':
+        return minmax_indices(y, max_points)
+    raise ValueError(f"Unrecognized downsampling method: {method}")
+
+
+def downsample_series(series, max_points=DEFAULT_MAX_POINTS, method='lttb'):
+    '''
+    series: series indexed by its x values
+    max_points: number of points to keep, None keeps all of them
+    method: lttb or minmax
+
+    missing values are dropped
+    '''
+    return series.iloc[downsample_indices(series.index, series.values,
+                                          max_points, method)]
@@ -1,29 +1,82 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from datetimerange import DateTimeRange
-from dateutil.relativedelta import relativedelta
-from datetime import time
-import plotly.graph_objects as go
 from pandas.tseries.offsets import DateOffset
 
+from ..data.dtypes import WEEKDAYS
 from ..data.make_dataset import resample_df
+from ..data.rollup import ROLLUP_CACHE
+from ..features.correlation import (
+    CORRELATION_CACHE, correlation_matrix, top_k_columns
+)
+from .downsample import (
+    DEFAULT_MAX_POINTS, downsample_indices, downsample_series
+)
+
+
+def _sorted_range(values, start, end, lo=0, hi=None):
+    # positions [lo, hi) of the sorted values between start and end,
+    # both included, by binary search
+    hi = len(values) if hi is None else hi
+    return (lo + values[lo:hi].searchsorted(start, 'left'),
+            lo + values[lo:hi].searchsorted(end, 'right'))
+
+
+def _df_date_range_selector(df, date_range_start=None, date_range_end=None,
+                            stop_no=None):
+    '''
+    df: dataframe indexed by sorted time, or by sorted (stop_no, time)
+    date_range_start: start date included
+    date_range_end: end date included
+    stop_no: only select this station of a (stop_no, time) frame
 
-def _df_date_range_selector(df, date_range_start, date_range_end):
-    if date_range_start and date_range_end:
-        mask = (df.index >= date_range_start) & (df.index <= date_range_end)
-    elif date_range_start:
-        mask = (df.index >= date_range_start)
+    Slices the rows in O(log n), per station for (stop_no, time) frames.
+    One station, or a frame indexed by time only, comes back as a view.
+    '''
+    start = pd.Timestamp(date_range_start or pd.Timestamp.min)
+    end = pd.Timestamp(date_range_end or pd.Timestamp.max)
+    index = df.index
+    if not index.is_monotonic_increasing:
+        times = index.get_level_values(-1)
+        mask = (times >= start) & (times <= end)
+        if stop_no is not None:
+            mask &= index.get_level_values(0) == stop_no
+        return df.loc[mask]
+
+    if index.nlevels == 1:
+        lo, hi = _sorted_range(index, start, end)
+        return df.iloc[lo:hi]
+
+    # codes of a sorted multiindex are sorted within every station too,
+    # so the bounds are searched among codes instead of values
+    stop_codes, time_codes = index.codes[0], index.codes[-1]
+    if stop_no is None:
+        codes = np.arange(len(index.levels[0]))
     else:
-        mask = (df.index <= date_range_end)
-    return df.loc[mask]    
+        codes = [index.levels[0].get_indexer([stop_no])[0]]
+    stations = zip(stop_codes.searchsorted(codes, 'left'),
+                   stop_codes.searchsorted(codes, 'right'))
+    times = index.levels[-1]
+    start_code = times.searchsorted(start, 'left')
+    end_code = times.searchsorted(end, 'right') - 1
+
+    ranges = [_sorted_range(time_codes, start_code, end_code, lo, hi)
+              for lo, hi in stations]
+    ranges = [(lo, hi) for lo, hi in ranges if lo < hi]
+    if len(ranges) == 1:
+        return df.iloc[ranges[0][0]:ranges[0][1]]
+    return df.iloc[np.concatenate(
+        [np.arange(lo, hi) for lo, hi in ranges] or [[]]).astype(int)]
 
 
 def draw_line_plot_by_column(
     df, columns=None, font_prop='', color='white',
     label_size=14, title_size=16, fig_size=(12, 8),
     date_range_start=None, date_range_end=None,
-    allow_null=True, hue=None, grid=True
+    allow_null=True, hue=None, grid=True,
+    max_points=DEFAULT_MAX_POINTS, downsample_method='lttb'
     ):
     '''
     df: dataframe
@@ -38,7 +91,12 @@ def draw_line_plot_by_column(
     allow_null: allow any null values in column and will draw the plot by 
                 skipping them
     hue: seaborn hue
+    max_points: points drawn per column, None draws all of them
+    downsample_method: lttb or minmax
     '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
     if date_range_start or date_range_end:
         df = _df_date_range_selector(df, date_range_start, date_range_end)
     if columns:
@@ -46,18 +104,21 @@ def draw_line_plot_by_column(
     if hue:
         df_hue = df[hue]
 
-    df = df.select_dtypes(include=['float64', 'int64'])
+    df = df.select_dtypes(include=['number'])
     for column in df.columns:
-        x = df.index
         y = df[column]
         if allow_null or not y.isnull().values.sum():
+            kept = downsample_indices(df.index, y.values,
+                                      max_points, downsample_method)
+            x = df.index[kept]
+            y = y.iloc[kept]
             plt.figure(figsize=fig_size)
             plt.xticks(color=color, fontsize=label_size)
             plt.yticks(color=color, fontsize=label_size)
             plt.title(column, fontproperties=font_prop,
                     fontsize=title_size, color=color)
             if hue:
-                sns.lineplot(x, y[:-1], hue=df_hue) # hack for y value
+                sns.lineplot(x, y[:-1], hue=df_hue.iloc[kept]) # hack for y value
                 plt.legend(loc='upper right', prop=font_prop, fontsize=label_size)
             else:
                 sns.lineplot(x, y)
@@ -71,7 +132,9 @@ def draw_line_plot_by_column(
 def draw_heatmap_by_column(
     df, font_prop='', color='white',
     label_size=14, fig_size=(12, 12),
-    date_range_start=None, date_range_end=None
+    date_range_start=None, date_range_end=None,
+    method='pearson', lag=0, top_k=None, target=None,
+    cache=CORRELATION_CACHE
     ):
     '''
     df: dataframe
@@ -81,16 +144,33 @@ def draw_heatmap_by_column(
     fig_size: matplotlib figure size
     date_range_start: start date included
     date_range_end: end date excluded
+    method: pearson or spearman
+    lag: rows the columns lag behind the rows of the matrix
+    top_k: columns drawn, the most correlated ones, None draws all
+    target: with top_k, draw target and the columns most correlated
+            with it
+    cache: correlation cache, None computes the matrix every call
     '''
-    if date_range_start or date_range_end:
-        df = _df_date_range_selector(df, date_range_start, date_range_end)
-    df = df.select_dtypes(include=['float64', 'int64'])
+    import matplotlib.pyplot as plt
+
+    if cache is not None:
+        # keyed on the whole frame and the range, a slice would be a new
+        # frame on every call
+        corr = cache.get(df, method, lag, start=date_range_start,
+                         end=date_range_end, select=_df_date_range_selector)
+    else:
+        if date_range_start or date_range_end:
+            df = _df_date_range_selector(df, date_range_start,
+                                         date_range_end)
+        corr = correlation_matrix(df, method, lag)
+    if top_k is not None and top_k < len(corr):
+        corr = top_k_columns(corr, top_k, target)
 
     f = plt.figure(figsize=fig_size)
-    plt.matshow(df.corr(), fignum=f.number)
-    plt.xticks(range(df.shape[1]), df.columns, fontproperties=font_prop,
+    plt.matshow(corr, fignum=f.number)
+    plt.xticks(range(corr.shape[1]), corr.columns, fontproperties=font_prop,
                fontsize=label_size, rotation=75, color=color)
-    plt.yticks(range(df.shape[1]), df.columns,
+    plt.yticks(range(corr.shape[0]), corr.index,
                fontproperties=font_prop, fontsize=label_size, color=color)
     cb = plt.colorbar()
     cb.ax.tick_params(labelsize=label_size, labelcolor=color, color=color)
@@ -99,7 +179,8 @@ def draw_heatmap_by_column(
 def plot_youbike_mean_available_number(
     df, freq='realtime', color='white',
     label_size=14, title_size=16, fig_size=(12, 8),
-    grid=True):
+    grid=True, max_points=DEFAULT_MAX_POINTS, downsample_method='lttb',
+    cache=ROLLUP_CACHE):
     '''
     df: dataframe
     freq: dataframe resample frequency
@@ -107,7 +188,12 @@ def plot_youbike_mean_available_number(
     label_size: label font size
     title_size: title font size
     fig_size: matplotlib figure size
+    max_points: points drawn, None draws all of them
+    downsample_method: lttb or minmax
+    cache: rollup cache, None resamples df every call
     '''
+    import matplotlib.pyplot as plt
+
     freq_dict = {
         'realtime': '5 Minutes(realtime)',
         'H': 'Hour',
@@ -115,13 +201,11 @@ def plot_youbike_mean_available_number(
         'M': 'Month'
     }
 
-    if freq == 'realtime':
-        df_ = df
-    else:
-        df_ = df.resample(freq).mean()
+    df_ = resample_df(df, freq=None if freq == 'realtime' else freq,
+                      cache=cache)
 
-    x = df_.index
-    y = df_.current_number
+    y = downsample_series(df_.current_number, max_points, downsample_method)
+    x = y.index
     plt.figure(figsize=fig_size)
     plt.title(
         f"Youbike Mean Available Number per {freq_dict[freq]} at University of Taipei",
@@ -135,10 +219,129 @@ def plot_youbike_mean_available_number(
     plt.plot(x, y)
 
 
+def _date_periods(start_date, end_date, days_per_period):
+    starts = pd.date_range(start=start_date, end=end_date,
+                           freq=f"{days_per_period}D")
+    return [(start, start + DateOffset(days=days_per_period))
+            for start in starts]
+
+
+def _draw_panels(fig, periods, font_prop='', color='white',
+                 label_size=14, title_size=16, grid=True,
+                 max_points=DEFAULT_MAX_POINTS, downsample_method='lttb'):
+    # periods x columns panels, one row per (start, end, df) period; x is
+    # the days since the period start, so the panels share the x axis and
+    # only the bottom row gets x tick labels
+    font_prop = font_prop or None
+    columns = periods[0][2].columns
+    axes = fig.subplots(len(periods), len(columns), sharex=True,
+                        sharey='col', squeeze=False)
+    for row, (start, end, df) in zip(axes, periods):
+        for ax, column in zip(row, columns):
+            y = downsample_series(df[column], max_points, downsample_method)
+            ax.plot((y.index - start) / pd.Timedelta('1D'), y.values)
+            ax.tick_params(colors=color, labelsize=label_size)
+            if grid:
+                ax.grid()
+        row[0].set_ylabel(f"{start:%Y-%m-%d}", color=color,
+                          fontsize=label_size, fontproperties=font_prop)
+    axes[0, 0].set_xlim(0, (periods[0][1] - periods[0][0]).days)
+    for ax, column in zip(axes[0], columns):
+        ax.set_title(column, fontproperties=font_prop,
+                     fontsize=label_size, color=color)
+    for ax in axes[-1]:
+        ax.set_xlabel('days', color=color, fontsize=label_size)
+    fig.suptitle(f"{periods[0][0]:%Y-%m-%d} ~ {periods[-1][1]:%Y-%m-%d}",
+                 fontproperties=font_prop, fontsize=title_size, color=color)
+
+
+def _save_panels(path, periods, fig_size, options):
+    from matplotlib.figure import Figure
+
+    # pyplot keeps no reference to a bare Figure, safe in worker processes
+    fig = Figure(figsize=fig_size)
+    _draw_panels(fig, periods, **options)
+    fig.savefig(path)
+    return path
+
+
+def draw_line_plot_grid(
+    df, columns=None, start_date=None, end_date=None,
+    days_per_period=7, periods_per_page=8, freq=None, font_prop='',
+    color='white', label_size=14, title_size=16, panel_size=(6, 2.5),
+    grid=True, max_points=DEFAULT_MAX_POINTS, downsample_method='lttb',
+    output_dir=None, file_format='png', workers=None, cache=ROLLUP_CACHE
+    ):
+    '''
+    df: dataframe
+    columns: draw specific columns, should be a list
+    start_date: first period start date, defaults to the first row
+    end_date: last period start date, defaults to the last row
+    days_per_period: days per row of panels
+    periods_per_page: rows of panels per figure, None puts every period
+                      in one figure
+    freq: resample frequency for dataframe: H, D
+    font_prop: fontproperties for matplotlib
+    color: color for label, title
+    label_size: label font size
+    title_size: title font size
+    panel_size: matplotlib size of every panel
+    max_points: points drawn per panel, None draws all of them
+    downsample_method: lttb or minmax
+    output_dir: save the figures here instead of showing them
+    file_format: image format of the saved figures
+    workers: processes saving the figures, defaults to the number of cpus
+    cache: rollup cache, None resamples df every call
+
+    Resamples df once and draws a periods x columns grid of panels, one
+    row per period and one column per numeric column, paged
+    periods_per_page rows at a time. Returns the saved file paths, if any.
+    '''
+    import matplotlib.pyplot as plt
+
+    df = resample_df(df, freq=freq, cache=cache)
+    if columns:
+        df = df[columns]
+    df = df.select_dtypes(include=['number'])
+    start_date = start_date or df.index.min().normalize()
+    end_date = end_date or df.index.max()
+
+    periods = []
+    for start, end in _date_periods(start_date, end_date, days_per_period):
+        df_ = df.loc[(df.index >= start) & (df.index < end)]
+        if len(df_):
+            periods.append((start, end, df_))
+    size = periods_per_page or len(periods)
+    pages = [periods[i:i + size] for i in range(0, len(periods), size)]
+
+    options = dict(font_prop=font_prop, color=color, label_size=label_size,
+                   title_size=title_size, grid=grid, max_points=max_points,
+                   downsample_method=downsample_method)
+    fig_sizes = [(panel_size[0] * len(df.columns),
+                  panel_size[1] * len(page)) for page in pages]
+    if output_dir is None:
+        for page, fig_size in zip(pages, fig_sizes):
+            fig = plt.figure(figsize=fig_size, layout='constrained')
+            _draw_panels(fig, page, **options)
+            plt.show()
+        return []
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            _save_panels,
+            [output_dir / f"{page[0][0]:%Y-%m-%d}.{file_format}"
+             for page in pages],
+            pages,
+            fig_sizes,
+            [options] * len(pages)))
+
+
 def plot_available_youbike_numbers(
     df, start_date='1/1/2018', end_date='6/15/2018',
     days_per_period=7, freq=None, font_prop='',
-    hue=None, grid=True
+    hue=None, grid=True, cache=ROLLUP_CACHE
     ):
     '''
     df: dataframe
@@ -148,6 +351,7 @@ def plot_available_youbike_numbers(
     freq: resample frequency for dataframe: H, D
     font_prop: fontproperties for matplotlib
     hue: seaborn hue, if freq is set, then hue will be set to None
+    cache: rollup cache, None resamples df every call
     '''
     columns=['可借車數']
     if freq:
@@ -155,16 +359,15 @@ def plot_available_youbike_numbers(
     if hue:
         columns += [hue]
 
-    date_range = pd.date_range(start=start_date, end=end_date, freq=f"{days_per_period}D")
-    for date in date_range:
-        start_date = date
-        end_date = date + DateOffset(days=days_per_period)
-
+    # resampled once, every period is sliced from it
+    df = resample_df(df, freq=freq, cache=cache)
+    for start_date, end_date in _date_periods(start_date, end_date,
+                                              days_per_period):
         start_date = str(start_date).split(' ')[0]
         end_date = str(end_date).split(' ')[0]
 
         draw_line_plot_by_column(
-            resample_df(df, freq=freq),
+            df,
             columns=columns,
             font_prop=font_prop, 
             date_range_start=start_date,
@@ -175,87 +378,108 @@ def plot_available_youbike_numbers(
         )
 
 
-def get_available_youbike_numbers_dfs_per_weekday(
-    df, weekdays='all'
+def _times_of_day(freq):
+    slots = pd.timedelta_range(
+        start='0s', periods=pd.Timedelta('1D') // pd.Timedelta(freq),
+        freq=freq)
+    return (pd.Timestamp(0) + slots).time
+
+
+def get_weekday_profiles(
+    df, column='可借車數', weekdays='all', freq='5min',
+    start_date=None, end_date=None, quantiles=None
 ):
     '''
-    df: dataframe
+    df: dataframe indexed by time, or by (stop_no, time)
+    column: column to profile
     weekdays: all or a list of weekdays, ex: ['Mon', 'Tue']
+    freq: time of day resolution
+    start_date: start date included
+    end_date: end date included
+    quantiles: list of quantiles, ex: [0.1, 0.5, 0.9], to profile the
+               distribution over dates instead of every date
+
+    returns a dict of weekday -> time x date matrix, or time x quantile
+    matrix, with stop_no as the outer column level for multiple stations;
+    every weekday is pivoted on its own, so no cell is left for the
+    dates of the other weekdays
     '''
-    key_column = '可借車數'
-    time_range = DateTimeRange("00:00:00", "23:55:00")
-    index_selectors = []
-    dfs_dict = {}
-    start_date = '2018-01-01'
-    end_date = '2018-06-15'
-    start_date_dict = {
-        'Mon': '2018-01-01',
-        'Tue': '2018-01-02',
-        'Wed': '2018-01-03',
-        'Thu': '2018-01-04',
-        'Fri': '2018-01-05',
-        'Sat': '2018-01-06',
-        'Sun': '2018-01-07'
-    }
-
     if weekdays == 'all':
-        weekdays = start_date_dict.keys()
-
-    for value in time_range.range(relativedelta(minutes=+5)):
-        time_str_list = str(value).split(' ')[-1].split(':') # XX:XX:XX
-        time_hour = int(time_str_list[0])
-        time_min = int(time_str_list[1])
-        time_sec = int(time_str_list[2])
-        index_selectors.append(
-            time(hour=time_hour, minute=time_min, second=time_sec)
-        )
-    thresh = len(index_selectors) * 0.9
-
+        weekdays = WEEKDAYS
+    times = df.index.get_level_values(-1)
+    mask = np.ones(len(df), dtype=bool)
+    if start_date:
+        mask &= times >= pd.Timestamp(start_date)
+    if end_date:
+        mask &= times <= pd.Timestamp(end_date)
+
+    times = times[mask]
+    dates = times.normalize().rename('date')
+    keys = [pd.Index((times - dates) // pd.Timedelta(freq), name='time')]
+    if df.index.nlevels > 1:
+        keys.append(df.index.get_level_values(0)[mask])
+    keys.append(dates)
+    values = pd.Series(df[column].values[mask])
+    rows_by_weekday = values.groupby(times.weekday).indices
+
+    times_of_day = pd.Index(_times_of_day(freq), name='time')
+    profiles = {}
     for weekday in weekdays:
-        df_weekday = df[df['星期幾'] == weekday]
-        df_weekday = df_weekday[[key_column]]
-
-        date_range = pd.date_range(start=start_date_dict[weekday], end=end_date, freq="7D")
-        df_new = pd.DataFrame()
+        rows = rows_by_weekday.get(WEEKDAYS.index(weekday), [])
+        weekday_keys = [key[rows] for key in keys]
+        if quantiles:
+            profile = (values.iloc[rows].groupby(weekday_keys[:-1])
+                                        .quantile(quantiles))
+        else:
+            profile = values.iloc[rows].groupby(weekday_keys).mean()
+        profile = (profile.unstack(list(range(1, profile.index.nlevels)))
+                          .sort_index(axis=1))
+        # one row per time slot, also the empty ones
+        profile = profile.reindex(range(len(times_of_day)))
+        profile.index = times_of_day
+        profiles[weekday] = profile
+    return profiles
 
-        for date in date_range:
-          start_date_ = date
-          end_date_ = date + DateOffset(days=1)
-          mask = (df_weekday.index > start_date_) & (df_weekday.index <= end_date_)
 
-          df_ = df_weekday.loc[mask]
-          df_ = df_.rename(columns={key_column: str(start_date_.date())})
-          df_.index = df_.index.time
-
-          if df_new.empty:
-            df_new = df_
-          else:
-            df_new = pd.concat([df_new, df_], axis=1)
+def get_available_youbike_numbers_dfs_per_weekday(
+    df, weekdays='all'
+):
+    '''
+    df: dataframe
+    weekdays: all or a list of weekdays, ex: ['Mon', 'Tue']
+    '''
+    thresh = len(_times_of_day('5min')) * 0.9
 
-        df_new = (df_new.loc[index_selectors]
-                        .dropna(axis=1, thresh=thresh)
-                        .fillna(method='ffill')
-                        .fillna(method='bfill')
-                  )
-        dfs_dict[weekday] = df_new
+    dfs_dict = {}
+    for weekday, df_ in get_weekday_profiles(df, weekdays=weekdays).items():
+        if df.index.nlevels == 1:
+            df_.columns = df_.columns.strftime('%Y-%m-%d')
+        # dates with less than 90% of the slots are dropped
+        dfs_dict[weekday] = df_.dropna(axis=1, thresh=thresh).ffill().bfill()
 
     return dfs_dict
 
 
 def draw_available_youbike_numbers_per_weekday(
-    df, weekdays='all', mode='lines+markers'
+    df, weekdays='all', mode='lines+markers',
+    max_points=DEFAULT_MAX_POINTS, downsample_method='lttb'
 ):
     '''
     df: dataframe
     weekdays: all or a list of weekdays, ex: ['Mon', 'Tue']
     mode: plotly mode
+    max_points: points drawn per trace, None draws all of them
+    downsample_method: lttb or minmax
     '''
+    import plotly.graph_objects as go
+
     dfs_dict = get_available_youbike_numbers_dfs_per_weekday(df, weekdays=weekdays)
 
     for weekday, df_ in dfs_dict.items():
         fig = go.Figure()
         for column in df_.columns:
-            fig.add_trace(go.Scatter(x=df_.index, y=df_[column],
+            y = downsample_series(df_[column], max_points, downsample_method)
+            fig.add_trace(go.Scatter(x=y.index, y=y,
                             mode='lines+markers',
                             name=column))
         # Edit the layout
@@ -280,7 +504,7 @@ def draw_available_youbike_numbers_per_weekday(
                 )
             ])
 
-        fig.update_layout(title=f"Youbike Available Number per {weekday} from 2018-01-01 to 2018-06-15",
+        fig.update_layout(title=f"Youbike Available Number per {weekday} from {df_.columns.min()} to {df_.columns.max()}",
                             xaxis_title='Time',
                             yaxis_title='Youbike Available Number')
         fig.show()
\ No newline at end of file
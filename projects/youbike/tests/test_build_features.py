@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.features.build_features import (
+    LAG_TOLERANCE, LAGS, ROLLING_WINDOWS, TARGET_COLUMN, WEATHER_DELTA,
+    build_features
+)
+
+
+WEATHER = ['氣溫(℃)', '降水量(mm)']
+
+
+def _integration_df(seed=0):
+    # three stations on a 5 minute grid with dropped readings and missing
+    # targets, over more than the 1 week lag
+    rng = np.random.default_rng(seed)
+    frames = []
+    for stop in [3, 1, 2]:
+        times = pd.date_range('2018-03-01', '2018-03-10', freq='5min')
+        times = times[rng.random(len(times)) > 0.1]
+        target = rng.integers(0, 40, len(times)).astype('float64')
+        target[rng.random(len(times)) < 0.05] = np.nan
+        frames.append(pd.DataFrame({
+            'stop_no': stop,
+            'db_update_time': times,
+            TARGET_COLUMN: target,
+            '是否為週末': times.weekday >= 5,
+            WEATHER[0]: rng.normal(20, 5, len(times)),
+            WEATHER[1]: rng.gamma(1, 1, len(times))
+        }))
+    return pd.concat(frames).set_index(['stop_no', 'db_update_time'])
+
+
+def _merge_asof_lag(df, columns, lag, tolerance):
+    # value of every station at (t - lag), matched backward in time
+    left = pd.DataFrame({
+        'stop_no': df['stop_no'].values,
+        'lag_time': df['db_update_time'].values - pd.Timedelta(lag),
+        'position': np.arange(len(df))
+    }).sort_values('lag_time', kind='mergesort')
+    right = df[['stop_no', 'db_update_time'] + columns].sort_values(
+        'db_update_time', kind='mergesort')
+    lagged = pd.merge_asof(left, right, left_on='lag_time',
+                           right_on='db_update_time', by='stop_no',
+                           tolerance=pd.Timedelta(tolerance))
+    return lagged.sort_values('position')[columns].values
+
+
+def _pandas_features(df):
+    # the grouped rolling / merge_asof features FeatureHistory replaced
+    df = df.reset_index().sort_values(['stop_no', 'db_update_time'],
+                                      kind='mergesort')
+    features = {}
+    for name, lag in LAGS.items():
+        features[f"{TARGET_COLUMN}_lag_{name}"] = _merge_asof_lag(
+            df, [TARGET_COLUMN], lag, LAG_TOLERANCE)[:, 0]
+    for name, window in ROLLING_WINDOWS.items():
+        rolling = (df.groupby('stop_no', sort=False)
+                     .rolling(window, on='db_update_time',
+                              closed='left')[TARGET_COLUMN])
+        features[f"{TARGET_COLUMN}_rolling_mean_{name}"] = (
+            rolling.mean().values)
+        features[f"{TARGET_COLUMN}_rolling_std_{name}"] = rolling.std().values
+    previous = _merge_asof_lag(df, WEATHER, WEATHER_DELTA, WEATHER_DELTA)
+    for i, column in enumerate(WEATHER):
+        features[column] = df[column].values
+        features[f"{column}_delta_{WEATHER_DELTA}"] = (
+            df[column].values - previous[:, i])
+    index = pd.MultiIndex.from_frame(df[['stop_no', 'db_update_time']])
+    return pd.DataFrame(features, index=index).astype('float32')
+
+
+@pytest.fixture(scope='module')
+def integration_df():
+    return _integration_df()
+
+
+def test_features_match_pandas_reference(integration_df):
+    result = build_features(integration_df)
+    expected = _pandas_features(integration_df)
+    pd.testing.assert_index_equal(result.index, expected.index)
+    for column in expected.columns:
+        np.testing.assert_allclose(result[column], expected[column],
+                                   rtol=1e-4, atol=1e-3, err_msg=column)
+
+
+def test_incremental_features_match_full_build(integration_df):
+    since = pd.Timestamp('2018-03-09 12:00')
+    full = build_features(integration_df)
+    times = full.index.get_level_values('db_update_time')
+    pd.testing.assert_frame_equal(build_features(integration_df, since=since),
+                                  full[times > since])
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.features.correlation import CorrelationEngine
+
+
+@pytest.mark.parametrize('splits', [
+    # first update shorter than the largest lag
+    [3, 50, 147],
+    # updates of one row
+    [1] * 8 + [192],
+    [120, 80],
+])
+def test_split_updates_match_single_update(splits):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(200, 3)), columns=['a', 'b', 'c'])
+    df.iloc[::7, 1] = np.nan
+    lags = [0, 1, 5]
+    expected = CorrelationEngine(df.columns, lags=lags).update(df)
+
+    engine = CorrelationEngine(df.columns, lags=lags)
+    bounds = np.cumsum([0] + splits)
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        engine.update(df.iloc[lo:hi])
+
+    assert engine.rows == len(df)
+    for lag in lags:
+        pd.testing.assert_frame_equal(engine.correlation(lag),
+                                      expected.correlation(lag))
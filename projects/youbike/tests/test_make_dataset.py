@@ -0,0 +1,31 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data.make_dataset import _hourly_timestamps
+
+
+def _iterrows_timestamps(index, date_str):
+    # the row loop _hourly_timestamps replaced
+    date_column = []
+    date = pd.to_datetime(date_str)
+    for label in index:
+        date_column.append(date + pd.DateOffset(hours=label))
+        if (label + 1) % 24 == 0:
+            date += pd.DateOffset(days=1)
+    return pd.DatetimeIndex(date_column)
+
+
+@pytest.mark.parametrize('labels', [
+    # one 0-23 block per day, as in the weather csv files
+    np.tile(np.arange(24), 3),
+    # contiguous labels across days
+    np.arange(72),
+    # ragged blocks with missing and repeated hours
+    np.array([0, 1, 5, 23, 0, 3, 22, 23, 23, 47, 2, 10]),
+])
+def test_hourly_timestamps_match_iterrows(labels):
+    index = pd.Index(labels)
+    expected = _iterrows_timestamps(index, '2018-03-10')
+    result = _hourly_timestamps(index, '2018-03-10')
+    pd.testing.assert_index_equal(result, expected)
@@ -0,0 +1,55 @@
+import numpy as np
+import pandas as pd
+
+from src.data.matrix import open_matrix, update_matrix, write_matrix
+from src.data.store import write_youbike_store
+
+
+def _youbike_df(stations, start, end):
+    # readings every 2 minutes, several per 5-minute slot
+    times = pd.date_range(start, end, freq='2min', inclusive='left')
+    rng = np.random.default_rng(0)
+    return pd.DataFrame({
+        'stop_no': np.repeat(stations, len(times)).astype('int32'),
+        'db_update_time': np.tile(times, len(stations)),
+        'current_number': rng.integers(0, 40, len(stations) * len(times),
+                                       dtype='int16'),
+        'vacancy_number': rng.integers(0, 40, len(stations) * len(times),
+                                       dtype='int16')
+    })
+
+
+def test_update_matches_a_rebuild(tmp_path):
+    january = _youbike_df([1, 2], '2018-01-30', '2018-02-01')
+    february = _youbike_df([1, 2], '2018-02-01', '2018-02-02 03:00')
+    store_path, path = tmp_path / 'youbike', tmp_path / 'matrix'
+    write_youbike_store(january, store_path)
+    write_matrix(store_path, path)
+
+    write_youbike_store(february, store_path)
+    assert update_matrix(february, path) == (2, 59 * 24 * 12)
+
+    expected_path = tmp_path / 'expected'
+    write_matrix(store_path, expected_path)
+    matrix, expected = open_matrix(path), open_matrix(expected_path)
+    assert matrix.shape == expected.shape
+    for column in matrix.columns:
+        np.testing.assert_array_equal(matrix.values[column],
+                                      expected.values[column])
+    np.testing.assert_array_equal(matrix.mask, expected.mask)
+
+
+def test_update_needs_a_rebuild(tmp_path):
+    store_path, path = tmp_path / 'youbike', tmp_path / 'matrix'
+    assert update_matrix(_youbike_df([1], '2018-01-01', '2018-01-02'),
+                         path) is None
+
+    write_youbike_store(_youbike_df([1], '2018-01-01', '2018-01-02'),
+                        store_path)
+    write_matrix(store_path, path, spare_months=1)
+    # a new station, and a row past the spare month
+    assert update_matrix(_youbike_df([2], '2018-01-02', '2018-01-03'),
+                         path) is None
+    assert update_matrix(_youbike_df([1], '2018-03-01', '2018-03-02'),
+                         path) is None
+    assert open_matrix(path).shape == (1, 31 * 24 * 12)
@@ -0,0 +1,31 @@
+import asyncio
+
+import numpy as np
+import pandas as pd
+
+from src.models.predict_model import MicroBatcher
+
+
+class _EchoPredictor:
+    def predict(self, stops, times):
+        return pd.Series(stops.astype('float64'))
+
+
+def test_cancelled_request_does_not_stop_the_batcher():
+    async def scenario():
+        batcher = MicroBatcher(_EchoPredictor(), max_delay=0.01)
+        worker = asyncio.ensure_future(batcher.run())
+        times = ['2018-03-01 10:00']
+        cancelled = asyncio.ensure_future(batcher.predict([1], times))
+        answered = asyncio.ensure_future(batcher.predict([2], times))
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        first = await asyncio.wait_for(answered, 1)
+        # a request after the batch with the cancelled future
+        second = await asyncio.wait_for(batcher.predict([3], times), 1)
+        worker.cancel()
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    np.testing.assert_array_equal(first, [2])
+    np.testing.assert_array_equal(second, [3])
@@ -0,0 +1,51 @@
+import numpy as np
+import pandas as pd
+
+from src.data.store import (
+    compact_parquet_store, list_partitions, read_feature_store,
+    read_time_bounds, write_feature_store
+)
+
+
+def test_time_bounds_match_the_time_column(tmp_path):
+    times = pd.date_range('2018-01-03 01:05', '2018-04-20 07:35',
+                          freq='5min')
+    df = pd.DataFrame({
+        'stop_no': np.repeat([1, 2], len(times)),
+        'db_update_time': np.concatenate([times, times[::-1]]),
+        'value': 1.0
+    })
+    path = tmp_path / 'features'
+    # several files per partition, the bounds are not in the last one
+    for rows in np.array_split(np.arange(len(df)), 3):
+        write_feature_store(df.iloc[rows], path)
+
+    times = read_feature_store(path).index.get_level_values('db_update_time')
+    assert read_time_bounds(path) == (times.min(), times.max())
+
+
+def test_time_bounds_of_an_empty_store(tmp_path):
+    assert read_time_bounds(tmp_path) == (None, None)
+
+
+def test_compaction_keeps_the_rows(tmp_path):
+    times = pd.date_range('2018-01-31', '2018-02-03', freq='5min',
+                          inclusive='left')
+    df = pd.DataFrame({
+        'stop_no': np.repeat([1, 2], len(times)),
+        'db_update_time': np.tile(times, 2),
+        'value': np.arange(2 * len(times), dtype='float64')
+    })
+    path = tmp_path / 'features'
+    # one append for january, two for february
+    for day in ['2018-01-31', '2018-02-01', '2018-02-02']:
+        write_feature_store(df[df['db_update_time'].dt.normalize() == day],
+                            path)
+    expected = read_feature_store(path)
+
+    assert compact_parquet_store(path, 'db_update_time',
+                                 months=['2018-01']) == 0
+    assert compact_parquet_store(path, 'db_update_time', min_files=2) == 4
+    pd.testing.assert_frame_equal(read_feature_store(path), expected)
+    assert all(len(list(directory.glob('*.parquet'))) == 1
+               for directory in list_partitions(path))